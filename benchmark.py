@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# encoding: UTF-8
+
+"""Time SchizoidPy's hot paths, without a display, so that runs
+can be compared to catch regressions.
+
+    benchmark.py --out new.json
+    benchmark.py --baseline old.json
+
+The benchmarks are:
+
+save: Task.save at several key depths and counts, with the keys
+  given directly or partly through dkey_prefix, and with the
+  debug log, lazy_data, or compact_lists on. With lazy_data, how
+  long it then takes to build 'data' is reported separately.
+save/columns: Task.save of numbers a field at a time, as for
+  ('rt', trial), which is the layout compact_lists is meant for,
+  with it off and on.
+write: Task.write on the data of a session with many trials,
+  saved a trial at a time or a field at a time.
+loop: one iteration of the response loops of button_screen and
+  keypress_screen, with a headless Task (see schizoidpy.Headless)
+  standing in for the window and input.
+trigger: how long TriggerLink.send takes, and how long it is
+  from then until the pins are set, with each transport and with
+  the worker in a thread or a process. Codes are written to a
+  temporary file rather than the parallel port.
+
+Each benchmark is run --repeat times, and the median is reported,
+in seconds. With --baseline, each figure is compared to the same
+one in an earlier run's --out file, and the exit status is 1 if
+any is more than --tolerance slower."""
+
+import os
+import gc
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+from time import sleep
+from timeit import default_timer as clock
+import numpy
+from schizoidpy import Task, Headless, TriggerLink, trigger_transports
+
+def headless_task(responder = None, **options):
+    return Task(headless = Headless(responder or (lambda *a: (1, None))), **options)
+
+def timed(f, *args):
+    gc.disable()
+    start = clock()
+    try:
+        f(*args)
+    finally:
+        elapsed = clock() - start
+        gc.enable()
+    return elapsed
+
+def save_keys(depth, count):
+    rest = tuple('level{}'.format(j) for j in range(depth - 2))
+    return [(('trial', i), rest) for i in range(count)]
+
+def bench_save(depth, count, prefixed = False, **options):
+    keys = save_keys(depth, count)
+    o = headless_task(**options)
+    def run():
+        if prefixed:
+            for prefix, rest in keys:
+                with o.dkey_prefix(prefix):
+                    o.save(rest, 1.5)
+        else:
+            for prefix, rest in keys:
+                o.save(prefix + rest, 1.5)
+    seconds = timed(run)
+    result = dict(per_save = seconds / count)
+    if o.lazy_data:
+        result['materialize'] = timed(lambda: o.data)
+    o.done()
+    return result
+
+def bench_save_columns(count, **options):
+    o = headless_task(**options)
+    seconds = timed(fill_columns, o, count)
+    o.done()
+    return dict(per_save = seconds / (2 * count))
+
+def fill(o, trials):
+    for i in range(trials):
+        with o.dkey_prefix(('trial', i)):
+            o.save('stimulus', 'stim{}'.format(i % 40))
+            o.save('choice', 'AB'[i % 2])
+            o.save('rt', .5 + (i % 97) / 100.)
+            o.save('correct', i % 3 != 0)
+            o.save_timestamp('choice', 0)
+            o.save_timestamp('choice', 1)
+
+def fill_columns(o, trials):
+    for i in range(trials):
+        o.save(('rt', i), .5 + (i % 97) / 100.)
+        o.save(('correct', i), i % 3 != 0)
+
+def bench_write(trials, tmp, columns = False, **options):
+    o = headless_task(**options)
+    (fill_columns if columns else fill)(o, trials)
+    o.done()
+    return dict(write = timed(o.write, os.path.join(tmp, 'out.json')))
+
+def bench_loop(screen, **options):
+    # The simulated subject takes a while to respond, so the
+    # screen goes through a few thousand iterations first.
+    def responder(kind, dkey, choices):
+        return 60, ('A' if kind == 'button' else 'j')
+    o = headless_task(responder, **options)
+    flips = o.headless.flips
+    if screen == 'button':
+        seconds = timed(o.button_screen, 'b', o.button(-.5, 0, 'A'), o.button(.5, 0, 'B'))
+    else:
+        seconds = timed(o.keypress_screen, 'k', dict(j = 1, k = 2), o.text(0, 0, 'Press J or K'))
+    iterations = o.headless.flips - flips
+    o.done()
+    return dict(per_iteration = seconds / iterations)
+
+def bench_trigger(transport, threaded, codes, tmp):
+    delay = .001
+    link = TriggerLink(delay, None, 'queue',
+        os.path.join(tmp, 'port.txt'), threaded, transport)
+    enqueue = []
+    for code in range(1, codes + 1):
+        sleep(3 * delay)
+        enqueue.append(timed(link.send, code))
+    records = link.close()
+    latency = [pins_set - enqueued
+        for code, enqueued, received, pins_set, pins_reset, status in records]
+    return dict(
+        send = float(numpy.median(enqueue)),
+        latency_median = float(numpy.median(latency)),
+        latency_p95 = float(numpy.percentile(latency, 95)))
+
+def benchmarks(args, tmp):
+    counts = [1000] if args.quick else [1000, 10000]
+    for depth in 3, 6:
+        for count in counts:
+            name = 'save/depth{}/n{}'.format(depth, count)
+            yield name, bench_save, (depth, count), {}
+            yield name + '/prefixed', bench_save, (depth, count), dict(prefixed = True)
+            yield name + '/debug_log', bench_save, (depth, count), dict(debug_log_dir = tmp)
+            yield name + '/lazy_data', bench_save, (depth, count), dict(lazy_data = True)
+            yield name + '/compact_lists', bench_save, (depth, count), dict(compact_lists = True)
+    for count in counts:
+        name = 'save/columns/n{}'.format(count)
+        yield name, bench_save_columns, (count,), {}
+        yield name + '/compact_lists', bench_save_columns, (count,), dict(compact_lists = True)
+    for trials in [1000] if args.quick else [1000, 20000]:
+        name = 'write/trials{}'.format(trials)
+        yield name, bench_write, (trials, tmp), {}
+        yield name + '/compact_lists', bench_write, (trials, tmp), dict(compact_lists = True)
+        yield name + '/deferred_timestamps', bench_write, (trials, tmp), dict(deferred_timestamps = True)
+        yield name + '/columns', bench_write, (trials, tmp), dict(columns = True)
+        yield name + '/columns/compact_lists', bench_write, (trials, tmp), dict(columns = True, compact_lists = True)
+    for screen in 'button', 'keypress':
+        name = 'loop/{}_screen'.format(screen)
+        yield name, bench_loop, (screen,), {}
+        yield name + '/capture_input', bench_loop, (screen,), dict(capture_input = True)
+    for transport in sorted(trigger_transports):
+        for worker in 'thread', 'process':
+            yield ('trigger/{}/{}'.format(transport, worker), bench_trigger,
+                (transport, worker == 'thread', 50 if args.quick else 200, tmp), {})
+
+def run_all(args):
+    tmp = tempfile.mkdtemp(prefix = 'schizoidpy-benchmark-')
+    results = {}
+    try:
+        for name, f, f_args, options in benchmarks(args, tmp):
+            if args.only and not any(name.startswith(x) for x in args.only):
+                continue
+            runs = [f(*f_args, **options) for _ in range(args.repeat)]
+            results[name] = dict((k, float(numpy.median([r[k] for r in runs])))
+                for k in runs[0])
+            print >>sys.stderr, name, ' '.join(
+                '{}={:.3g}'.format(k, v) for k, v in sorted(results[name].items()))
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+def compare(results, baseline, tolerance):
+    'Print how results compare to baseline and return the regressions.'
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        for k in sorted(set(results[name]) & set(baseline[name])):
+            new, old = results[name][k], baseline[name][k]
+            ratio = new / old if old else float('inf')
+            slower = ratio > 1 + tolerance
+            if slower:
+                regressions.append((name, k))
+            print '{:50} {:>16} {:10.3g} {:10.3g} {:7.2f}x{}'.format(
+                name, k, old, new, ratio, '  SLOWER' if slower else '')
+    return regressions
+
+def main():
+    p = argparse.ArgumentParser(description = __doc__,
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--out', metavar = 'FILE',
+        help = 'write the results to FILE as JSON')
+    p.add_argument('--baseline', metavar = 'FILE',
+        help = 'compare the results to those in FILE')
+    p.add_argument('--tolerance', type = float, default = .2,
+        help = 'how much slower than the baseline counts as a regression (default: %(default)s)')
+    p.add_argument('--repeat', type = int, default = 5,
+        help = 'runs of each benchmark (default: %(default)s)')
+    p.add_argument('--quick', action = 'store_true',
+        help = 'use smaller sizes')
+    p.add_argument('--only', metavar = 'PREFIX', action = 'append',
+        help = 'only run benchmarks whose names start with PREFIX')
+    args = p.parse_args()
+
+    results = run_all(args)
+    if args.out:
+        with open(args.out, 'w') as out:
+            json.dump(dict(
+                python = platform.python_version(),
+                platform = platform.platform(),
+                repeat = args.repeat,
+                results = results), out, sort_keys = True, indent = 2)
+            print >>out
+    if args.baseline:
+        with open(args.baseline) as inp:
+            baseline = json.load(inp)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    # On Windows, trigger worker processes import this module, so
+    # only the parent should run the benchmarks.
+    main()
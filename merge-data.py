@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# encoding: UTF-8
+
+"""Merge the JSON files written by Task.write into one table,
+with a row per file and a column per dkey, as both CSV and a NumPy
+.npz of typed columns.
+
+Column names are dkeys joined with '/', the same keys Task.save
+would be given, so ('times', 'intro', 0) becomes 'times/intro/0'.
+Files are parsed in parallel. Each file's flattened row is cached,
+as a pickle, in a directory beside the output, along with the kind
+of each of its values, so when this is run again, only new or
+changed files are parsed, and the column types can be worked out
+without loading any rows. Only one row at a time is held in memory
+while the CSV is written. A file that can't be read or parsed is
+left out, with a warning."""
+
+import os
+import sys
+import csv
+import json
+import cPickle as pickle
+import hashlib
+import argparse
+import multiprocessing
+import numpy
+from schizoidpy import flatten
+
+def column_name(key):
+    return u'/'.join(unicode(k) for k in key)
+
+def kind_of(value):
+    return (
+        None if value is None else
+        'bool' if isinstance(value, bool) else
+        'int' if isinstance(value, (int, long)) else
+        'float' if isinstance(value, float) else
+        'str')
+
+def merge_kinds(a, b):
+    if a is None or a == b: return b
+    if b is None: return a
+    if set((a, b)) == set(('int', 'float')): return 'float'
+    return 'str'
+
+def cache_path(cache_dir, path):
+    return os.path.join(cache_dir,
+        hashlib.sha1(os.path.abspath(path).encode('UTF-8')).hexdigest() + '.pickle')
+
+def flatten_file(job):
+    """Parse one output file and cache its row. The cache holds
+    two pickles: first a header with the file's size and mtime and
+    the kind of each value, and then the row itself. Return the
+    path and, if the file couldn't be read or parsed, the error
+    message."""
+    path, cache = job
+    try:
+        with open(path) as inp:
+            data = json.load(inp)
+    except (IOError, ValueError) as e:
+        return path, str(e)
+    row = dict((column_name(k), v) for k, v in flatten(data))
+    st = os.stat(path)
+    with open(cache, 'wb') as out:
+        pickle.dump(dict(path = path, size = st.st_size, mtime = st.st_mtime,
+            kinds = dict((k, kind_of(v)) for k, v in row.items())),
+            out, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(row, out, pickle.HIGHEST_PROTOCOL)
+    return path, None
+
+def cached_header(cache, path):
+    'Return the header of the cache for path, or None if it is stale.'
+    if not os.path.exists(cache):
+        return None
+    with open(cache, 'rb') as inp:
+        header = pickle.load(inp)
+    st = os.stat(path)
+    if header['size'] != st.st_size or header['mtime'] != st.st_mtime:
+        return None
+    return header
+
+def cached_row(cache):
+    with open(cache, 'rb') as inp:
+        pickle.load(inp)
+          # Skip the header.
+        return pickle.load(inp)
+
+def input_files(paths):
+    for p in paths:
+        if os.path.isdir(p):
+            for name in sorted(os.listdir(p)):
+                if name.endswith('.json'):
+                    yield os.path.join(p, name)
+        else:
+            yield p
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs = '+', metavar = 'FILE_OR_DIR')
+    parser.add_argument('-o', '--out', default = 'merged',
+        help = 'write OUT.csv and OUT.npz (default: merged)')
+    parser.add_argument('-j', '--jobs', type = int,
+        default = multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    cache_dir = args.out + '.cache'
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    paths = list(input_files(args.inputs))
+    # First pass: find the columns and their types, from the
+    # cache headers alone, parsing the files that aren't cached.
+    kinds = {}
+    present = {}
+    def add_kinds(header):
+        for k, kind in header['kinds'].items():
+            kinds[k] = merge_kinds(kinds.get(k), kind)
+            if kind is not None:
+                present[k] = present.get(k, 0) + 1
+    stale = []
+    for p in paths:
+        header = cached_header(cache_path(cache_dir, p), p)
+        if header is None:
+            stale.append(p)
+        else:
+            add_kinds(header)
+    failed = set()
+    if stale:
+        pool = multiprocessing.Pool(args.jobs)
+        for p, error in pool.imap_unordered(flatten_file,
+                [(p, cache_path(cache_dir, p)) for p in stale]):
+            if error is not None:
+                print >>sys.stderr, 'Skipping {}: {}'.format(p, error)
+                failed.add(p)
+        pool.close()
+        pool.join()
+        for p in stale:
+            if p not in failed:
+                add_kinds(cached_header(cache_path(cache_dir, p), p))
+        paths = [p for p in paths if p not in failed]
+    print 'Parsed {} of {} files'.format(len(stale) - len(failed),
+        len(paths) + len(failed))
+    if failed:
+        print 'Skipped {} unreadable file(s)'.format(len(failed))
+
+    columns = sorted(kinds)
+    for k in columns:
+        if kinds[k] in ('int', 'bool') and present.get(k, 0) < len(paths):
+            # We need NaN for the missing values.
+            kinds[k] = 'float'
+
+    # Second pass: write the CSV and fill in the arrays.
+    dtypes = {None: numpy.float64, 'bool': bool, 'int': numpy.int64,
+        'float': numpy.float64, 'str': object}
+    arrays = dict((k, numpy.empty(len(paths), dtype = dtypes[kinds[k]]))
+        for k in columns)
+    for k in columns:
+        if arrays[k].dtype == numpy.float64:
+            arrays[k].fill(numpy.nan)
+        elif arrays[k].dtype == object:
+            arrays[k].fill(u'')
+    with open(args.out + '.csv', 'wb') as out:
+        w = csv.writer(out)
+        w.writerow(['source_file'] + [k.encode('UTF-8') for k in columns])
+        for i, p in enumerate(paths):
+            row = cached_row(cache_path(cache_dir, p))
+            w.writerow([p] + [
+                '' if row.get(k) is None else
+                row[k].encode('UTF-8') if isinstance(row[k], unicode) else
+                row[k]
+                for k in columns])
+            for k, v in row.items():
+                if v is not None:
+                    arrays[k][i] = unicode(v) if kinds[k] == 'str' else v
+    arrays = dict((k, v.astype(unicode) if v.dtype == object else v)
+        for k, v in arrays.items())
+    numpy.savez_compressed(args.out + '.npz',
+        source_file = numpy.array(paths, dtype = unicode),
+        **dict((k.encode('UTF-8'), v) for k, v in arrays.items()))
+    print 'Wrote {} rows and {} columns to {}.csv and {}.npz'.format(
+        len(paths), len(columns) + 1, args.out, args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# encoding: UTF-8
+
+"""Show live statistics for a running Task that has
+'monitor_socket' set to SOCKET.
+
+    monitor.py /tmp/schizoidpy.sock
+
+The monitor can be started before or after the task, and stopped
+and restarted while it runs; the task never waits for it. Every
+--interval seconds, and when the task calls 'done', it prints how
+many saves and trigger codes it has received, the running accuracy,
+RT percentiles, how many frames were dropped, and how many records
+it missed. Accuracy comes from saves whose last key is --accuracy-key
+and whose values are true or false. RTs come from
+('sys', 'response_times') (see the Task option capture_input), and
+from numeric saves whose last key is --rt-key. Dropped frames come
+from ('sys', 'frames') (see record_frames)."""
+
+import os
+import json
+import socket
+import argparse
+from time import time
+import numpy
+
+max_datagram = 1 << 20
+  # Bigger than any datagram Task sends (see
+  # schizoidpy.Publisher.max_message).
+
+class Stats(object):
+    def __init__(self, accuracy_key, rt_key):
+        self.accuracy_key = accuracy_key
+        self.rt_key = rt_key
+        self.next_number = None
+        self.missed = self.saves = self.triggers = 0
+        self.frames = self.dropped_frames = 0
+        self.correct = []
+        self.rts = []
+        self.done = False
+
+    def add(self, record):
+        number, kind = record[:2]
+        if self.next_number is not None:
+            self.missed += number - self.next_number
+        self.next_number = number + 1
+        if kind == 'save':
+            self.saves += 1
+            key, value = record[2:]
+            if not isinstance(key, list):
+                key = [key]
+            if key[:2] == ['sys', 'frames'] and isinstance(value, dict):
+                self.frames += value['frames']
+                self.dropped_frames += value['dropped']
+            elif key[:2] == ['sys', 'response_times'] and isinstance(value, dict):
+                self.rts.append(value['event']
+                    if value['event'] is not None
+                    else value['detected'])
+            elif key[-1] == self.accuracy_key and isinstance(value, bool):
+                self.correct.append(value)
+            elif (key[-1] == self.rt_key and isinstance(value, (int, float))
+                    and not isinstance(value, bool)):
+                self.rts.append(value)
+        elif kind == 'trigger':
+            self.triggers += 1
+        elif kind == 'done':
+            self.done = True
+
+    def summary(self):
+        rt = None
+        if self.rts:
+            median, p90, p99 = numpy.percentile(self.rts, [50, 90, 99])
+            rt = dict(n = len(self.rts),
+                median = median, p90 = p90, p99 = p99)
+        return dict(
+            saves = self.saves,
+            triggers = self.triggers,
+            accuracy = dict(n = len(self.correct),
+                mean = numpy.mean(self.correct) if self.correct else None),
+            rt = rt,
+            frames = self.frames,
+            dropped_frames = self.dropped_frames,
+            missed_records = self.missed,
+            done = self.done)
+
+def report(summary):
+    def num(x):
+        return '-' if x is None else '{:.3f}'.format(x)
+    rt = summary['rt'] or dict(n = 0, median = None, p90 = None, p99 = None)
+    print ('saves {saves}  triggers {triggers}  '
+        'accuracy {acc} (n = {acc_n})  '
+        'RT median {median} p90 {p90} p99 {p99} (n = {rt_n})  '
+        'dropped frames {dropped_frames}/{frames}  '
+        'missed {missed_records}{done_note}').format(
+            acc = num(summary['accuracy']['mean']),
+            acc_n = summary['accuracy']['n'],
+            median = num(rt['median']), p90 = num(rt['p90']), p99 = num(rt['p99']),
+            rt_n = rt['n'],
+            done_note = '  (done)' if summary['done'] else '',
+            **summary)
+
+def main():
+    p = argparse.ArgumentParser(description = __doc__,
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    p.add_argument('socket')
+    p.add_argument('--interval', type = float, default = 5,
+        help = 'seconds between reports (default: %(default)s)')
+    p.add_argument('--accuracy-key', default = 'correct')
+    p.add_argument('--rt-key', default = 'rt')
+    p.add_argument('--json', action = 'store_true',
+        help = 'print each report as a line of JSON')
+    args = p.parse_args()
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(args.socket)
+    sock.settimeout(args.interval)
+    stats = Stats(args.accuracy_key, args.rt_key)
+    buf = bytearray(max_datagram)
+    last_report = time()
+    try:
+        while not stats.done:
+            try:
+                n = sock.recv_into(buf)
+                stats.add(json.loads(str(buf[:n])))
+            except socket.timeout:
+                pass
+            except ValueError:
+                # A datagram that was cut off or garbled. The gap it
+                # leaves in the record numbers counts it as missed.
+                pass
+            if stats.done or time() - last_report >= args.interval:
+                if args.json:
+                    print json.dumps(stats.summary(), sort_keys = True)
+                else:
+                    report(stats.summary())
+                last_report = time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.remove(args.socket)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+#!/usr/bin/python
+# encoding: UTF-8
+
+"""Rebuild the JSON output of a crashed session from the journal
+that a Task with 'journal_dir' set was writing.
+
+    recover-journal.py journal-2019-01-01-12-00-00-000000.jsonl out.json"""
+
+import sys
+from schizoidpy import replay_journal, write_data
+
+if len(sys.argv) != 3:
+    sys.exit(__doc__)
+journal_path, write_path = sys.argv[1:]
+
+write_data(replay_journal(journal_path), write_path)
+print "Wrote", write_path
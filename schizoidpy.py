@@ -1,23 +1,76 @@
 # encoding: UTF-8
 
-from collections import namedtuple
-from copy import deepcopy
-from datetime import datetime
+from collections import namedtuple, OrderedDict, deque
+from datetime import datetime, timedelta
 from socket import gethostname
-from time import sleep
+from time import sleep, time
 import os.path
+import math
+import random
+import atexit
+import threading
 import json
-import numpy
-import wx
-import pyglet
-from psychopy.monitors import Monitor
-import psychopy.gui.wxgui
-from psychopy.core import Clock, CountdownTimer, wait
-from psychopy.logging import debug, warning
-from psychopy.event import Mouse, getKeys, clearEvents
-from psychopy.visual import \
-    Window, Rect, Circle, TextStim
-from psychopy.visual.ratingscale import RatingScale
+import struct
+import errno
+import sys
+from importlib import import_module
+
+class lazy(object):
+    """A stand-in for a module, or for something in a module, that
+    isn't imported until it's first used, so importing SchizoidPy
+    doesn't have to wait for wx, pyglet, numpy, and PsychoPy. On
+    first use, the global variable 'name' is rebound to the real
+    thing, so later uses cost nothing extra. With 'mixin', the real
+    thing is a new class that inherits from 'mixin' and then from
+    the imported class."""
+    def __init__(self, name, module, attr = None, mixin = None):
+        self.name = name
+        self.module = module
+        self.attr = attr
+        self.mixin = mixin
+        self.value = None
+    def get(self):
+        if self.value is None:
+            value = import_module(self.module)
+            if self.attr is not None:
+                value = getattr(value, self.attr)
+            if self.mixin is not None:
+                value = type(self.name, (self.mixin, value),
+                    dict(__doc__ = self.mixin.__doc__))
+            self.value = value
+            if globals().get(self.name) is self:
+                globals()[self.name] = value
+        return self.value
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+    def __instancecheck__(self, x):
+        # If the module hasn't been imported yet, nothing can be
+        # an instance of anything in it.
+        return self.module in sys.modules and isinstance(x, self.get())
+
+def lazy_base(module, attr):
+    'A class decorator to make the class a lazy subclass of module.attr.'
+    return lambda cls: lazy(cls.__name__, module, attr, mixin = cls)
+
+numpy = lazy('numpy', 'numpy')
+wx = lazy('wx', 'wx')
+pyglet = lazy('pyglet', 'pyglet')
+psychopy_event = lazy('psychopy_event', 'psychopy.event')
+for name, module in (
+        ('Clock', 'psychopy.core'), ('CountdownTimer', 'psychopy.core'),
+        ('wait', 'psychopy.core'), ('getTime', 'psychopy.core'),
+        ('debug', 'psychopy.logging'), ('warning', 'psychopy.logging'),
+        ('Mouse', 'psychopy.event'), ('getKeys', 'psychopy.event'),
+        ('clearEvents', 'psychopy.event'),
+        ('Window', 'psychopy.visual'), ('Rect', 'psychopy.visual'),
+        ('Circle', 'psychopy.visual'), ('TextStim', 'psychopy.visual'),
+        ('BufferImageStim', 'psychopy.visual'),
+        ('Dlg', 'psychopy.gui.wxgui'),
+        ('RatingScale', 'psychopy.visual.ratingscale')):
+    globals()[name] = lazy(name, module, name)
+del name, module
 
 standard_actiview_trigger_codes = dict(
     START_LISTENING = 255,
@@ -48,8 +101,658 @@ def tuplecat(a, b): return (
  (a if isinstance(a, tuple) else (a,)) +
  (b if isinstance(b, tuple) else (b,)))
 
-def abs_timestamp_str():
-    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+def frame_summary(flip_times, frame_period):
+    '''Summarize the flip times of one screen. An inter-frame
+    interval more than half again as long as frame_period counts
+    as one or more dropped frames. A None in flip_times means the
+    window was deliberately left alone for a while, so the
+    interval across it doesn't count.'''
+    flip_times = numpy.array(
+        [numpy.nan if t is None else t for t in flip_times], dtype = float)
+    ifis = numpy.diff(flip_times)
+    ifis = ifis[~numpy.isnan(ifis)]
+    frames = int(numpy.sum(~numpy.isnan(flip_times)))
+    if not len(ifis):
+        return dict(frames = frames, dropped = 0)
+    late = ifis[ifis > 1.5 * frame_period]
+    median, p95, p99 = numpy.percentile(ifis, [50, 95, 99])
+    return dict(
+        frames = frames,
+        dropped = int(numpy.sum(numpy.round(late / frame_period) - 1)),
+        ifi_mean = float(ifis.mean()),
+        ifi_median = float(median),
+        ifi_p95 = float(p95),
+        ifi_p99 = float(p99),
+        ifi_max = float(ifis.max()))
+
+def cpu_time():
+    'Seconds of CPU time used by this process so far.'
+    t = os.times()
+    return t[0] + t[1]
+
+def make_monotonic_ns():
+    """Return a function that reads the operating system's
+    monotonic clock, in integer nanoseconds. It's shared by all
+    processes, isn't moved by changes to the wall-clock time, and
+    is cheap enough to read on every save."""
+    import ctypes, ctypes.util
+    if sys.platform == 'win32':
+        kernel32 = ctypes.windll.kernel32
+        frequency = ctypes.c_int64()
+        kernel32.QueryPerformanceFrequency(ctypes.byref(frequency))
+        def monotonic_ns():
+            counter = ctypes.c_int64()
+            kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+            return counter.value * 10**9 // frequency.value
+    elif sys.platform == 'darwin':
+        class timebase_info(ctypes.Structure):
+            _fields_ = [('numer', ctypes.c_uint32), ('denom', ctypes.c_uint32)]
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        libc.mach_absolute_time.restype = ctypes.c_uint64
+        timebase = timebase_info()
+        libc.mach_timebase_info(ctypes.byref(timebase))
+        def monotonic_ns():
+            return libc.mach_absolute_time() * timebase.numer // timebase.denom
+    else:
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        clock_gettime = ctypes.CDLL(
+            ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+            ).clock_gettime
+        CLOCK_MONOTONIC = 1
+        def monotonic_ns():
+            t = timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+            return t.tv_sec * 10**9 + t.tv_nsec
+    return monotonic_ns
+monotonic_ns = make_monotonic_ns()
+
+def monotonic():
+    'monotonic_ns in seconds.'
+    return monotonic_ns() / 1e9
+
+def utcnow():
+    'The wall-clock time, which Headless replaces with virtual time.'
+    return datetime.utcnow()
+
+class Timestamp(object):
+    """A reading of monotonic_ns, saved in place of a formatted
+    timestamp when a Task has deferred_timestamps on, and formatted
+    only when the data is written. 'zero' is the reading relative
+    timestamps are measured from."""
+    __slots__ = ('ns', 'zero')
+    def __init__(self, ns, zero):
+        self.ns, self.zero = ns, zero
+    def __repr__(self):
+        return 'Timestamp({}, {})'.format(self.ns, self.zero)
+
+def hashable(x):
+    """Return x, or, if it's an unhashable sequence (like a list
+    or a NumPy array, either of which PsychoPy accepts as a
+    color), a tuple of its elements."""
+    try:
+        hash(x)
+        return x
+    except TypeError:
+        return tuple(numpy.ravel(x).tolist())
+
+class LRUCache(object):
+    'A dictionary that forgets its least recently used entries.'
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, make):
+        '''Return the value for 'key', calling 'make' to create
+        it if it isn't cached.'''
+        try:
+            value = self.entries.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = make()
+            self.misses += 1
+            if len(self.entries) >= self.max_entries:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+        self.entries[key] = value
+        return value
+
+    def stats(self):
+        return dict(
+            entries = len(self.entries),
+            max_entries = self.max_entries,
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions)
+
+class TrialList(object):
+    """What Task.save makes in place of a list of numbers, as for a
+    key like ('rt', trial), when compact_lists is on. As long as
+    all its elements are numbers of one type, it keeps them in
+    NumPy arrays of chunk_size elements each, except for the last
+    few, which it keeps in an ordinary list until there are enough
+    for another chunk. Otherwise, or once an index far past the end
+    is used, it keeps them in a dictionary, so it's never padded
+    out with Nones. Missing elements read as None, as in the padded
+    list, and 'tolist' makes that list, which is how the TrialList
+    is written out."""
+    dtypes = {bool: 'bool', int: 'int64', float: 'float64'}
+    chunk_size = 1024
+
+    def __init__(self):
+        self.length = 0
+        self.type = None
+        self.chunks = []
+        self.present = []
+          # For each chunk, a boolean array marking which of its
+          # elements are present (rather than None), or just None
+          # if they all are.
+        self.tail = []
+        self.items = None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        if self.items is not None:
+            return self.items.get(i)
+        c, j = divmod(i, self.chunk_size)
+        if c == len(self.chunks):
+            return self.tail[j]
+        if self.present[c] is not None and not self.present[c][j]:
+            return None
+        return self.chunks[c][j].item()
+
+    def __setitem__(self, i, value):
+        if (i == self.length and type(value) is self.type and
+                len(self.tail) < self.chunk_size - 1):
+            # The usual case: appending another number of the same
+            # type.
+            self.tail.append(value)
+            self.length += 1
+            return
+        if self.items is None:
+            if self.type is None and type(value) in self.dtypes:
+                self.type = type(value)
+            if (type(value) is not self.type or
+                    i >= 2 * self.length + self.chunk_size):
+                self.spill()
+        if self.items is not None:
+            self.items[i] = value
+            self.length = max(self.length, i + 1)
+            return
+        j = i - self.chunk_size * len(self.chunks)
+        if j < 0:
+            # Fill in a gap in a chunk.
+            c, j = divmod(i, self.chunk_size)
+            self.chunks[c][j] = value
+            if self.present[c] is not None:
+                self.present[c][j] = True
+            return
+        if j < len(self.tail):
+            self.tail[j] = value
+            return
+        if j > len(self.tail):
+            self.tail.extend((j - len(self.tail)) * [None])
+        self.tail.append(value)
+        self.length = i + 1
+        while len(self.tail) >= self.chunk_size:
+            self.add_chunk()
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+    def __repr__(self):
+        return 'TrialList({!r})'.format(self.tolist())
+
+    def add_chunk(self):
+        'Move the first chunk_size elements of the tail into a new chunk.'
+        values = self.tail[:self.chunk_size]
+        del self.tail[:self.chunk_size]
+        present = [v is not None for v in values]
+        self.chunks.append(numpy.array(
+            [0 if v is None else v for v in values],
+            self.dtypes[self.type]))
+        self.present.append(None if all(present) else numpy.array(present))
+
+    def spill(self):
+        'Move the elements out of the chunks and into a dictionary.'
+        self.items = dict(self.nonempty())
+        self.type = self.chunks = self.present = self.tail = None
+
+    def nonempty(self):
+        "Yield (index, element) for each element that isn't None."
+        if self.items is not None:
+            for i in sorted(self.items):
+                if self.items[i] is not None:
+                    yield i, self.items[i]
+            return
+        for c, (chunk, present) in enumerate(zip(self.chunks, self.present)):
+            values = chunk.tolist()
+            for j in (range(len(values)) if present is None
+                    else numpy.flatnonzero(present).tolist()):
+                yield c * self.chunk_size + j, values[j]
+        start = self.chunk_size * len(self.chunks)
+        for j, v in enumerate(self.tail):
+            if v is not None:
+                yield start + j, v
+
+    def tolist(self):
+        if self.items is None and not any(p is not None for p in self.present):
+            # There are no gaps in the chunks, so they can be
+            # converted wholesale.
+            l = []
+            for chunk in self.chunks:
+                l.extend(chunk.tolist())
+            return l + self.tail
+        l = self.length * [None]
+        for i, v in self.nonempty():
+            l[i] = v
+        return l
+
+def autovivify(data, key, value, compact_lists = False):
+    """The guts of Task.save. 'key' should already include the
+    dkey prefix. With 'compact_lists', a new list whose elements
+    will be numbers, as for a key like ('rt', trial), is made a
+    TrialList."""
+    if isinstance(key, tuple):
+        seq = data
+        last = len(key) - 1
+        for i, k in enumerate(key):
+            if isinstance(seq, dict):
+                if k in seq:
+                    seq = seq[k]
+                    continue
+            elif isinstance(seq, TrialList):
+                if k < seq.length and seq[k] is not None:
+                    seq = seq[k]
+                    continue
+            elif isinstance(seq, list):
+                if len(seq) - 1 < k:
+                    # The list is too short. Pad it out with Nones.
+                    seq[len(seq):] = (k + 1 - len(seq)) * [None]
+                elif seq[k] is not None:
+                    seq = seq[k]
+                    continue
+            else: raise KeyError
+            # The slot is empty, so fill it with the value, or with
+            # a new container for the rest of the key.
+            newobj = (
+                 value if i == last else
+                 {} if not isinstance(key[i + 1], int) else
+                 TrialList() if (compact_lists and i + 1 == last and
+                     type(value) in TrialList.dtypes) else
+                 [])
+            seq[k] = newobj
+            seq = newobj
+    elif isinstance(key, str):
+        data[key] = value
+    else:
+        raise KeyError
+
+def flatten(data, prefix = ()):
+    """The inverse of autovivify: yield a (key, value) pair for
+    each leaf of 'data', where 'key' is the tuple that would be
+    passed to Task.save."""
+    if isinstance(data, dict):
+        for k in sorted(data):
+            for pair in flatten(data[k], prefix + (k,)):
+                yield pair
+    elif isinstance(data, TrialList) and prefix:
+        for i, v in data.nonempty():
+            for pair in flatten(v, prefix + (i,)):
+                yield pair
+    elif isinstance(data, (list, tuple)) and prefix:
+        for i, v in enumerate(data):
+            if v is not None:
+                for pair in flatten(v, prefix + (i,)):
+                    yield pair
+    else:
+        yield prefix, data
+
+def write_data(data, write_path, json_default = None):
+    with open(write_path, "w") as out:
+        json.dump(data, out, sort_keys = True, indent = 2,
+            default = json_default)
+        print >>out
+
+class Journal(object):
+    """A file with one line of JSON per save, from which
+    replay_journal can rebuild a Task's data after a crash. Saving
+    only encodes the line; like a DebugLog, the Journal is written
+    by a background thread every 'flush_interval' seconds, and when
+    it's closed, which happens at exit if not before. Every
+    'checkpoint_interval' lines, the thread also fsyncs the journal
+    and appends the number of lines written so far to a separate
+    checkpoint file, so replay can tell a line that the crash cut
+    off from one that was damaged after it was safely on disk.
+    Unlike a DebugLog, a Journal never drops records."""
+    def __init__(self, path, checkpoint_interval, flush_interval, json_default = None):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.flush_interval = flush_interval
+        self.json_default = json_default
+        self.records = 0
+          # Written, that is.
+        self.out = open(path, 'w')
+        self.checkpoints = (open(path + '.checkpoint', 'w')
+            if checkpoint_interval else None)
+        self.buffer = deque()
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, key, value):
+        try:
+            line = json.dumps([key, value], default = self.json_default)
+        except (TypeError, ValueError):
+            # The value can't be encoded at all (e.g., it's a
+            # dictionary with tuple keys, or it contains itself),
+            # so journal its repr rather than crash the task.
+            line = json.dumps([key, repr(value)])
+        with self.lock:
+            self.buffer.append(line)
+
+    def close(self):
+        if not self.closing.is_set():
+            self.closing.set()
+            self.thread.join()
+            self.out.close()
+            if self.checkpoints is not None:
+                self.checkpoints.close()
+
+    def run(self):
+        while not self.closing.wait(self.flush_interval):
+            self.write_buffer()
+        self.write_buffer()
+
+    def write_buffer(self):
+        with self.lock:
+            lines = list(self.buffer)
+            self.buffer.clear()
+        for line in lines:
+            self.out.write(line)
+            self.out.write('\n')
+            self.records += 1
+            if (self.checkpoint_interval and
+                    self.records % self.checkpoint_interval == 0):
+                self.checkpoint()
+        self.out.flush()
+
+    def checkpoint(self):
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.checkpoints.write('{}\n'.format(self.records))
+        self.checkpoints.flush()
+        os.fsync(self.checkpoints.fileno())
+
+def journal_entry(line):
+    'Decode a line of a Journal into the key and value saved.'
+    key, value = json.loads(line)
+    return (tuple(key) if isinstance(key, list) else key.encode('UTF-8')), value
+
+def replay_journal(path):
+    """Rebuild the data of a Task from the Journal at 'path'. The
+    result is written by write_data the same way Task.write would
+    have written the original. A line that can't be decoded ends
+    the replay, as the crash must have cut it off, unless the
+    checkpoint file says it was already safely on disk, in which
+    case the journal has been damaged, and ValueError is raised."""
+    checkpointed = 0
+    if os.path.exists(path + '.checkpoint'):
+        with open(path + '.checkpoint') as inp:
+            for line in inp:
+                if line.endswith('\n'):
+                    # Otherwise, the crash cut this line off, too.
+                    checkpointed = int(line)
+    data = {}
+    replayed = 0
+    with open(path) as inp:
+        for line in inp:
+            try:
+                key, value = journal_entry(line)
+            except ValueError:
+                if replayed < checkpointed:
+                    raise ValueError('{}: line {} is damaged'.format(
+                        path, replayed + 1))
+                # The last line was only partly written before the
+                # crash.
+                break
+            autovivify(data, key, value)
+            replayed += 1
+    if replayed < checkpointed:
+        raise ValueError('{}: {} lines were checkpointed, but only {} are left'.format(
+            path, checkpointed, replayed))
+    return data
+
+class DebugLog(object):
+    """A debug log that's written by a background thread, so
+    saving never waits on the disk. Records wait in a ring buffer
+    of 'capacity' entries; if the writer falls that far behind,
+    the oldest records are dropped. The buffer is written out every
+    'flush_interval' seconds and fsynced every 'fsync_interval'
+    seconds, as well as when the log is closed, which happens at
+    exit if not before."""
+    def __init__(self, path, capacity, flush_interval, fsync_interval):
+        self.out = open(path, 'w')
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.buffer = deque()
+        self.lock = threading.Lock()
+        self.queued = self.dropped = 0
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, key, value):
+        with self.lock:
+            if len(self.buffer) >= self.capacity:
+                self.buffer.popleft()
+                self.dropped += 1
+            self.buffer.append((key, value))
+            self.queued += 1
+
+    def stats(self):
+        return dict(queued = self.queued, dropped = self.dropped)
+
+    def close(self):
+        if not self.closing.is_set():
+            self.closing.set()
+            self.thread.join()
+            self.out.close()
+
+    def run(self):
+        last_fsync = time()
+        while not self.closing.wait(self.flush_interval):
+            self.write_buffer()
+            if time() - last_fsync >= self.fsync_interval:
+                os.fsync(self.out.fileno())
+                last_fsync = time()
+        self.write_buffer()
+        os.fsync(self.out.fileno())
+
+    def write_buffer(self):
+        with self.lock:
+            records = list(self.buffer)
+            self.buffer.clear()
+        for key, value in records:
+            print >>self.out, 'Saved', repr(key), '|||', repr(value)
+        self.out.flush()
+
+class Publisher(object):
+    """Sends records, as JSON, in datagrams to a Unix-domain socket
+    at 'path', where monitor.py may be listening. The socket never
+    blocks. A record that can't be sent right away, because the
+    monitor isn't running or is falling behind, waits in a buffer
+    of 'capacity' records, the oldest of which are dropped when it
+    fills. Each record is numbered, so the monitor can count what
+    it missed."""
+    max_sends = 64
+      # The most records to send per call of 'publish', so that
+      # catching up on a long backlog doesn't hold up the task.
+    max_message = 32768
+      # The most bytes to put in one datagram. A save that would
+      # take more is published as a save of each of its leaves
+      # (see flatten) instead, and a leaf that's still too big is
+      # dropped.
+    def __init__(self, path, capacity, json_default):
+        import socket
+        if not hasattr(socket, 'AF_UNIX'):
+            raise Exception('Not implemented: monitor_socket without Unix-domain sockets')
+        self.socket_error = socket.error
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.path = path
+        self.json_default = json_default
+        self.backlog = deque(maxlen = capacity)
+        self.published = self.sent = self.dropped = 0
+
+    def publish(self, *record):
+        message = self.encode(record)
+        if len(message) > self.max_message and record[0] == 'save':
+            _, key, value = record
+            for leaf in flatten(value, key if isinstance(key, tuple) else (key,)):
+                self.enqueue(self.encode(('save',) + leaf))
+        else:
+            self.enqueue(message)
+        self.send_backlog(self.max_sends)
+
+    def send_backlog(self, max_sends):
+        'Send up to max_sends records from the backlog.'
+        for _ in range(max_sends):
+            if not self.backlog:
+                break
+            try:
+                self.sock.sendto(self.backlog[0], self.path)
+            except self.socket_error as e:
+                if e.errno == errno.EMSGSIZE:
+                    # It'll never fit, so give up on it.
+                    self.backlog.popleft()
+                    self.dropped += 1
+                    continue
+                # Otherwise, assume the monitor is missing or busy,
+                # and try again on the next call.
+                break
+            self.backlog.popleft()
+            self.sent += 1
+
+    def encode(self, record):
+        'Encode the record as JSON, numbered as the next to be published.'
+        return json.dumps((self.published,) + record, default = self.json_default)
+
+    def enqueue(self, message):
+        self.published += 1
+        if len(message) > self.max_message:
+            self.dropped += 1
+            return
+        if len(self.backlog) == self.backlog.maxlen:
+            self.dropped += 1
+        self.backlog.append(message)
+
+    def stats(self):
+        return dict(published = self.published, sent = self.sent,
+            dropped = self.dropped, unsent = len(self.backlog))
+
+    def close(self, timeout = 1):
+        """Spend up to 'timeout' seconds trying to send what's left
+        of the backlog, such as the record of the Task being done,
+        and then close the socket. Sends block meanwhile, so they
+        wait for the monitor to catch up instead of failing."""
+        deadline = time() + timeout
+        while self.backlog and time() < deadline:
+            self.sock.settimeout(max(0, deadline - time()))
+            left = len(self.backlog)
+            self.send_backlog(1)
+            if len(self.backlog) == left:
+                # The monitor is missing, or it didn't catch up in
+                # time.
+                break
+        self.sock.close()
+
+class ScreenProfiler(object):
+    """Attributes the wall-clock and CPU time of each screen to
+    phases, like drawing and saving. Functions wrapped with 'timed'
+    count toward their phase when called during a screen wrapped
+    with 'screen'. Time in a phase nested in another (like
+    'debug_log' in 'save') counts only toward the inner one, and
+    time in no phase counts toward 'other'."""
+    def __init__(self):
+        self.stack = []
+        self.screens = []
+        self.totals = {}
+          # Over all screens.
+
+    def timed(self, phase, f):
+        def timed_f(*args, **kwargs):
+            if not self.screens:
+                return f(*args, **kwargs)
+            self.enter(phase)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.exit()
+        return timed_f
+
+    def screen(self, task, f):
+        def screen_f(dkey, *args, **kwargs):
+            key = tuplecat(('sys', 'profile'), tuplecat(task.cur_dkey_prefix, dkey))
+            self.screens.append({})
+            self.enter('other')
+            try:
+                return f(dkey, *args, **kwargs)
+            finally:
+                wall, cpu = self.exit()
+                phases = self.screens.pop()
+                phases['total'] = [wall, cpu, 1]
+                task.store(key, dict(
+                    (phase, dict(wall = wall, cpu = cpu, calls = calls))
+                    for phase, (wall, cpu, calls) in phases.items()))
+        return screen_f
+
+    def enter(self, phase):
+        self.stack.append([phase, time(), cpu_time(), 0., 0.])
+
+    def exit(self):
+        phase, wall, cpu, child_wall, child_cpu = self.stack.pop()
+        wall, cpu = time() - wall, cpu_time() - cpu
+        for d in self.screens[-1], self.totals:
+            t = d.setdefault(phase, [0., 0., 0])
+            t[0] += wall - child_wall
+            t[1] += cpu - child_cpu
+            t[2] += 1
+        if self.stack:
+            self.stack[-1][3] += wall
+            self.stack[-1][4] += cpu
+        return wall, cpu
+
+def write_hotspots(path, screen_profiler, session_profile):
+    'Write a plain-text summary of where a session spent its time.'
+    import pstats
+    with open(path, 'w') as out:
+        if screen_profiler is not None:
+            print >>out, 'Time in screens by phase (seconds)\n'
+            print >>out, '{:<12}{:>12}{:>12}{:>10}'.format('phase', 'wall', 'cpu', 'calls')
+            for phase, (wall, cpu, calls) in sorted(
+                    screen_profiler.totals.items(), key = lambda x: -x[1][0]):
+                print >>out, '{:<12}{:>12.4f}{:>12.4f}{:>10}'.format(phase, wall, cpu, calls)
+            print >>out
+        if session_profile is not None:
+            stats = pstats.Stats(session_profile, stream = out)
+            for order in 'tottime', 'cumulative':
+                print >>out, 'Top functions by {}\n'.format(order)
+                stats.sort_stats(order).print_stats(25)
 
 class dkey_prefix(object):
     def __init__(self, task, my_prefix):
@@ -61,13 +764,58 @@ class dkey_prefix(object):
         self.task.cur_dkey_prefix = self.task.cur_dkey_prefix[len(self.my_prefix):]
 
 class timestamps(object):
-   def __init__(self, task, dkey):
+   def __init__(self, task, dkey, frames = None):
        self.task = task
        self.dkey = dkey
+       self.frames = frames
    def __enter__(self):
-       self.task.save_timestamp(self.dkey, 0)
+       self.entered = monotonic()
+       self.onset = None
+       if self.frames is not None or self.task.flip_onsets:
+           # Save the onset at the next flip.
+           self.task.pending_onsets.append(self)
+       else:
+           self.task.save_timestamp(self.dkey, 0)
+       if self.task.record_cpu_time:
+           self.cpu_started = cpu_time()
+       if self.task.record_frames:
+           self.outer_frame_times = self.task.frame_times
+           self.task.frame_times = []
+       return self
    def __exit__(self, _1, _2, _3):
-       self.task.save_timestamp(self.dkey, 1)
+       if self in self.task.pending_onsets:
+           # There was no flip, so fall back on the entry time.
+           self.task.pending_onsets.remove(self)
+           self.flipped_on(self.entered)
+       if self.frames is not None:
+           # The stimuli stay up until the next flip, so save the
+           # offset then.
+           self.durations_key = tuplecat(
+               tuplecat(('sys', 'durations'), self.task.cur_dkey_prefix),
+               self.dkey)
+           self.task.pending_offsets.append(self)
+       else:
+           self.task.save_timestamp(self.dkey, 1)
+       if self.task.record_cpu_time:
+           with self.task.dkey_prefix(('sys', 'cpu')):
+               self.task.save(self.dkey, cpu_time() - self.cpu_started)
+       if self.task.record_frames:
+           flip_times = self.task.frame_times
+           self.task.frame_times = self.outer_frame_times
+           if self.outer_frame_times is not None:
+               self.outer_frame_times.extend(flip_times)
+           self.task.save_frame_summary(self.dkey, flip_times)
+   def flipped_on(self, t):
+       self.onset = t
+       self.task.store(self.task.timestamp_key(self.dkey, 0), self.task.time_value(t))
+       self.offset_key = self.task.timestamp_key(self.dkey, 1)
+   def flipped_off(self, t):
+       self.task.store(self.offset_key, self.task.time_value(t))
+       self.task.store(self.durations_key, dict(
+           requested_frames = self.frames,
+           requested = self.frames * self.task.frame_period,
+           achieved = t - self.onset,
+           achieved_frames = int(round((t - self.onset) / self.task.frame_period))))
 
 class showing(object):
     def __init__(self, task, *stimuli):
@@ -75,8 +823,10 @@ class showing(object):
         self.stimuli = stimuli
     def __enter__(self):
         for s in self.stimuli: self.task.implicitly_draw.append(s)
+        self.task.implicitly_draw_changed()
     def __exit__(self, _1, _2, _3):
         for s in self.stimuli: self.task.implicitly_draw.remove(s)
+        self.task.implicitly_draw_changed()
 
 class hiding(object):
     def __init__(self, task, *stimuli):
@@ -85,14 +835,17 @@ class hiding(object):
     def __enter__(self):
         self.old_implicitly_draw = self.task.implicitly_draw[:]
         for s in self.stimuli: self.task.implicitly_draw.remove(s)
+        self.task.implicitly_draw_changed()
     def __exit__(self, _1, _2, _3):
         self.task.implicitly_draw = self.old_implicitly_draw
+        self.task.implicitly_draw_changed()
 
 class Button(object):
     def __init__(self, task, x, y, string, trigger_code = None, keybinding = None):
         self.task, self.x, self.y, self.string, self.trigger_code, self.keybinding = task, x, y, string, trigger_code, keybinding
+        self.radius = task.button_radius
         self.circle = Circle(task.win,
-            task.button_radius, pos = (x, y),
+            self.radius, pos = (x, y),
             lineColor = 'black', lineWidth = 3, edges = 64,
             fillColor = 'lightgray')
         self.text = task.text(x, y, string)
@@ -108,12 +861,111 @@ class Button(object):
         if ((any(self.task.mouse.getPressed())
                     and self.circle.contains(self.task.mouse))
                 or self.keybinding and getKeys([self.keybinding])):
-            self.was_pressed = True
-            if self.trigger_code is not None:
-                self.task.trigger(self.trigger_code)
+            self.press()
             return True
         return False
 
+    def press(self):
+        self.was_pressed = True
+        if self.trigger_code is not None:
+            self.task.trigger(self.trigger_code)
+
+class InputCapture(object):
+    """Records key presses and mouse clicks in 'events', with the
+    time each was dispatched, by pushing event handlers onto the
+    window. pyglet only dispatches a window's events on the thread
+    that made the window, so the capture can't run in a thread of
+    its own. Instead, it's pumped from the main thread by 'take',
+    which the screens call whenever they check for input, by
+    'pump_until', which the response loops call between frames so
+    that events are dispatched (and timed) soon after they happen
+    instead of once a frame, and by anything else that dispatches
+    events, like PsychoPy's getKeys and wait. A click that starts
+    and ends between pumps is still recorded, since the handler
+    sees the press."""
+    def __init__(self, win):
+        self.win = win
+        self.events = deque()
+        win.winHandle.push_handlers(
+            on_key_press = self.on_key_press,
+            on_mouse_press = self.on_mouse_press)
+    def on_key_press(self, symbol, modifiers):
+        # Name keys the way PsychoPy does.
+        name = pyglet.window.key.symbol_string(symbol).lower()
+        self.events.append(('key',
+            name[1:] if name.startswith('_') else name,
+            monotonic()))
+    def on_mouse_press(self, x, y, button, modifiers):
+        w, h = self.win.size
+        self.events.append(('mouse',
+            numpy.array([2. * x / w - 1, 2. * y / h - 1]),
+            monotonic()))
+    def take(self):
+        'Remove and return all the events recorded so far.'
+        self.win.winHandle.dispatch_events()
+        events = list(self.events)
+        self.events.clear()
+        return events
+    def pump_until(self, deadline, interval):
+        """Dispatch events every 'interval' seconds until an event
+        is recorded or 'deadline', a value of monotonic(), is near.
+        Return whether an event is waiting to be taken."""
+        while True:
+            self.win.winHandle.dispatch_events()
+            if self.events or monotonic() + interval > deadline:
+                return bool(self.events)
+            wait(interval, 0)
+    def clear(self):
+        self.take()
+    def close(self):
+        self.win.winHandle.remove_handlers(
+            on_key_press = self.on_key_press,
+            on_mouse_press = self.on_mouse_press)
+
+class TextBatch(object):
+    """A pyglet Batch with a label for each of some text stimuli
+    made by Task.text or Task.html, so they can all be drawn with
+    one call."""
+    def __init__(self, win, stimuli):
+        self.win = win
+        self.stimuli = stimuli
+          # Holding on to the stimuli keeps their IDs, which
+          # Task.batched uses to tell when they've changed, from
+          # being reused.
+        self.batch = pyglet.graphics.Batch()
+        self.labels = [self.label(s) for s in stimuli]
+
+    def label(self, stim):
+        kind, x, y, string, hAlign, vAlign, font_name, size = stim.batch_args
+        w, h = self.win.size
+        where = dict(
+            x = x * w / 2., y = y * h / 2.,
+            anchor_y = vAlign,
+            multiline = True, width = stim._wrapWidthPix,
+            batch = self.batch)
+        if kind == 'html':
+            label = pyglet.text.HTMLLabel(string, **where)
+            label.font_name = font_name
+            label.font_size = size
+            return label
+        return pyglet.text.Label(string,
+            font_name = font_name, font_size = size * h / 2., dpi = 72,
+            color = tuple(int(round((c + 1) * 127.5)) for c in stim.rgb) +
+                (int(round(255 * stim.opacity)),),
+            anchor_x = hAlign, align = hAlign,
+            **where)
+
+    def draw(self):
+        # Draw in pixels, with the origin at the center of the
+        # window, the way PsychoPy draws a TextStim.
+        pyglet.gl.glPushMatrix()
+        self.win.setScale('pix')
+        self.batch.draw()
+        pyglet.gl.glPopMatrix()
+
+    def delete(self):
+        for label in self.labels: label.delete()
+
 TriggerKey = namedtuple('TriggerKey', ['value', 'trigger_code'])
 
 wx_app = None
@@ -142,7 +994,8 @@ def okay(parent, default = False):
     if default: b.SetDefault()
     return b
 
-class SchizoidDlg(psychopy.gui.wxgui.Dlg):
+@lazy_base('psychopy.gui.wxgui', 'Dlg')
+class SchizoidDlg(object):
     """A Dlg without a Cancel button and with the ability to
     set field widths."""
     # Initially copied from psychopy.gui (which is copyright
@@ -216,10 +1069,24 @@ class SchizoidDlg(psychopy.gui.wxgui.Dlg):
         self.inputFields.append(inputBox)#store this to get data back on OK
         return inputBox
 
-class QuestionnaireDialog(wx.Dialog):
+@lazy_base('wx', 'Dialog')
+class QuestionnaireDialog(object):
+    """A dialog box with a notebook of pages of questions, each
+    answered on the same scale. To keep a long questionnaire from
+    holding up the dialog's first appearance, only the first page
+    is built at first; the rest are built when they're first
+    shown, or in idle time if 'prebuild_pages' is true. So that
+    the dialog never changes size while the subject is using it,
+    every page is as big as the first, which is the fullest and,
+    with the question column padded out to the wrap width, as
+    wide as any; a page that needs more room scrolls. Answers
+    are kept in self.responses, an array with one element per
+    question: the number of the chosen scale level, counting from
+    1, or 0 if the question is unanswered."""
     def __init__(self, parent, title, scale_levels,
           questions, questions_per_page,
-          font_size = None, column_filler_width = 100):
+          font_size = None, column_filler_width = 100,
+          prebuild_pages = True):
         wx.Dialog.__init__(self, parent, -1, title, wx.DefaultPosition)
 
         if font_size:
@@ -227,68 +1094,543 @@ class QuestionnaireDialog(wx.Dialog):
             font.SetPointSize(font_size)
             self.SetFont(font)
 
-        notebook = wx.Notebook(self, style = wx.BK_DEFAULT)
+        self.scale_levels = scale_levels
+        self.questions_per_page = questions_per_page
+        self.column_filler_width = column_filler_width
         self.questions = (
-            deepcopy(questions)
+            questions
             if isinstance(questions[0], dict)
             else [{'id': k, 'text': v} for k, v in enumerate(questions)])
+        self.responses = numpy.zeros(len(self.questions), dtype = int)
 
+        self.notebook = wx.Notebook(self, style = wx.BK_DEFAULT)
+        self.pages = []
         for qn1 in range(0, len(questions), questions_per_page):
-            panel = wx.Panel(notebook)
-
-            fgs = wx.FlexGridSizer(cols = 1 + len(scale_levels),
-                vgap = 5, hgap = 5)
-            # Add horizontal spaces to make all the response
-            # columns the same width.
-            fgs.Add(wx.Size(0, 0))
-            fgs.AddMany(len(scale_levels) * [wx.Size(column_filler_width, 0)])
-            # Add the column headers.
-            fgs.Add(wx.Size(0, 0))
-            for s in scale_levels:
-                fgs.Add(wrapped_text(panel, s), 0, wx.ALIGN_CENTER)
-            # Add the questions and radio buttons.
-            for q in self.questions[qn1 : qn1 + questions_per_page]:
-                wx.RadioButton(panel, pos = (-50, -50), style = wx.RB_GROUP)
-                  # Create a hidden radio button so that it appears that no
-                  # button is selected by default.
-                q['buttons'] = map(lambda _: wx.RadioButton(panel, -1), scale_levels)
-                fgs.Add(wrapped_text(panel, q['text']), 0, wx.ALIGN_CENTER_VERTICAL)
-                for b in q['buttons']:
-                    fgs.Add(b, 0, wx.ALIGN_CENTER)
-            # Add some trailing vertical space.
-            fgs.Add(wx.Size(0, 5))
-            panel.SetSizer(fgs)
-
-            notebook.AddPage(panel, "Page %d" % (qn1 / questions_per_page + 1,))
+            panel = wx.ScrolledWindow(self.notebook)
+            panel.SetScrollRate(20, 20)
+            self.pages.append(panel)
+            self.notebook.AddPage(panel,
+                "Page %d" % (qn1 / questions_per_page + 1,))
+        self.built = len(self.pages) * [False]
+        self.build_page(0)
+        self.notebook.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.on_page_changed)
+          # Not EVT_NOTEBOOK_PAGE_CHANGING, in which, on Windows,
+          # GetSelection returns the old page.
+        if prebuild_pages:
+            self.Bind(wx.EVT_IDLE, self.on_idle)
 
         b = box(self, wx.VERTICAL,
-            notebook,
+            self.notebook,
             (okay(self), 0, wx.ALIGN_CENTER_HORIZONTAL)).Fit(self)
 
-class PoisonPill: pass
-
-def trigger_worker(queue, trigger_code_delay, inpout32_addr):
+    def build_page(self, page):
+        if self.built[page]:
+            return
+        self.built[page] = True
+        panel = self.pages[page]
+        qn1 = page * self.questions_per_page
+
+        fgs = wx.FlexGridSizer(cols = 1 + len(self.scale_levels),
+            vgap = 5, hgap = 5)
+        # Add horizontal spaces to make all the response
+        # columns the same width, and the question column as
+        # wide as the widest question can be.
+        fgs.Add(wx.Size(wx_text_wrap_width, 0))
+        fgs.AddMany(len(self.scale_levels) * [wx.Size(self.column_filler_width, 0)])
+        # Add the column headers.
+        fgs.Add(wx.Size(0, 0))
+        for s in self.scale_levels:
+            fgs.Add(wrapped_text(panel, s), 0, wx.ALIGN_CENTER)
+        # Add the questions and radio buttons.
+        for qi in range(qn1, min(qn1 + self.questions_per_page, len(self.questions))):
+            wx.RadioButton(panel, pos = (-50, -50), style = wx.RB_GROUP)
+              # Create a hidden radio button so that it appears that no
+              # button is selected by default.
+            fgs.Add(wrapped_text(panel, self.questions[qi]['text']), 0, wx.ALIGN_CENTER_VERTICAL)
+            for level in range(1, len(self.scale_levels) + 1):
+                b = wx.RadioButton(panel, -1)
+                b.Bind(wx.EVT_RADIOBUTTON,
+                    lambda event, qi = qi, level = level: self.answer(qi, level))
+                fgs.Add(b, 0, wx.ALIGN_CENTER)
+        # Add some trailing vertical space.
+        fgs.Add(wx.Size(0, 5))
+        panel.SetSizer(fgs)
+        if page == 0:
+            # Size every page, and so the dialog, to fit this one.
+            panel.SetMinSize(fgs.GetMinSize())
+        panel.FitInside()
+
+    def answer(self, qi, level):
+        self.responses[qi] = level
+
+    def on_page_changed(self, event):
+        self.build_page(event.GetSelection())
+        event.Skip()
+
+    def on_idle(self, event):
+        if not all(self.built):
+            self.build_page(self.built.index(False))
+            event.RequestMore()
+
+STOP_WORKER = -1
+  # A trigger code that tells trigger_worker to return.
+listening_codes = frozenset((
+    standard_actiview_trigger_codes['START_LISTENING'],
+    standard_actiview_trigger_codes['STOP_LISTENING']))
+  # Codes that are never coalesced or rejected, since ActiView
+  # has to get them.
+
+class QueueTransport(object):
+    """Carries (code, time enqueued) pairs from TriggerLink to
+    trigger_worker on a Queue. It's the slowest transport, since
+    each pair is pickled and goes through the queue's feeder
+    thread, but also the most portable."""
+    def __init__(self, threaded):
+        if threaded:
+            from Queue import Queue
+        else:
+            from multiprocessing import Queue
+        self.queue = Queue()
+    def put(self, code, t):
+        self.queue.put((code, t))
+    def get(self, block = True):
+        """Return the next pair, or None if 'block' is false and
+        nothing is waiting."""
+        from Queue import Empty
+        try:
+            return self.queue.get(block, int(1e6))
+              # The long timeout (11 days) is to work around a
+              # Python bug.
+              # http://stackoverflow.com/a/1408476
+        except Empty:
+            return None
+
+class PipeTransport(object):
+    """Carries each pair as 12 bytes through a pipe, which the
+    worker wakes up from as soon as the bytes arrive."""
+    record = struct.Struct('<id')
+    def __init__(self, threaded):
+        from multiprocessing import Pipe
+        self.receiver, self.sender = Pipe(duplex = False)
+    def put(self, code, t):
+        self.sender.send_bytes(self.record.pack(code, t))
+    def get(self, block = True):
+        if not block and not self.receiver.poll():
+            return None
+        return self.record.unpack(self.receiver.recv_bytes())
+
+class SharedMemoryTransport(object):
+    """Carries pairs through a ring buffer in shared memory. There
+    being only one writer and one reader, the buffer needs no lock;
+    a semaphore counts the pairs waiting, so the worker can sleep
+    until there's one."""
+    def __init__(self, threaded, capacity = 1024):
+        from multiprocessing import RawArray, RawValue, Semaphore
+        self.capacity = capacity
+        self.codes = RawArray('l', capacity)
+        self.times = RawArray('d', capacity)
+        self.head = RawValue('L', 0) # Only written by 'put'
+        self.tail = RawValue('L', 0) # Only written by 'get'
+        self.waiting = Semaphore(0)
+    def put(self, code, t):
+        i = self.head.value
+        if i - self.tail.value >= self.capacity:
+            raise Exception('Trigger-code ring buffer is full')
+        self.codes[i % self.capacity] = code
+        self.times[i % self.capacity] = t
+        self.head.value = i + 1
+        self.waiting.release()
+    def get(self, block = True):
+        if not self.waiting.acquire(block, int(1e6) if block else None):
+            return None
+        i = self.tail.value
+        pair = (self.codes[i % self.capacity], self.times[i % self.capacity])
+        self.tail.value = i + 1
+        return pair
+
+trigger_transports = dict(
+    queue = QueueTransport,
+    pipe = PipeTransport,
+    shm = SharedMemoryTransport)
+
+def precise_sleep(secs):
+    """Wait for 'secs' seconds. We sleep for all but the last
+    couple of milliseconds, which we spin through, since 'sleep'
+    alone can overshoot by a lot more than that."""
+    deadline = monotonic() + secs
+    if secs > .002:
+        sleep(secs - .002)
+    while monotonic() < deadline:
+        pass
+
+class SimulatedPort(object):
+    """A stand-in for the parallel port that writes each code
+    it's sent to a file, one line apiece, after the value of
+    monotonic() when it was sent."""
+    def __init__(self, path):
+        self.out = open(path, 'a')
+    def __call__(self, code):
+        self.out.write('{:.9f} {}\n'.format(monotonic(), code))
+        self.out.flush()
+          # The worker process won't get a chance to flush the
+          # file when it exits.
+
+def trigger_sender(inpout32_addr, simulated_port = None):
+    if simulated_port is not None:
+        return SimulatedPort(simulated_port)
     if inpout32_addr is not None:
         from ctypes import windll
         try:
             dll = windll.inpoutx64
         except WindowsError:
             dll = windll.inpout32
-        send = lambda x: dll.Out32(inpout32_addr, x)
-    else:
-        from psychopy.parallel import setData
-        send = setData
-    while True:
-        trigger_code = queue.get(True, int(1e6))
-          # The long timeout (11 days) is to work around a Python
-          # bug.
-          # http://stackoverflow.com/a/1408476
-        if trigger_code == PoisonPill:
-            return
+        return lambda x: dll.Out32(inpout32_addr, x)
+    from psychopy.parallel import setData
+    return setData
+
+def trigger_worker(transport, results, trigger_code_delay, inpout32_addr,
+        overlap = 'queue', simulated_port = None):
+    """Send the trigger codes that come in on 'transport' as
+    (code, time enqueued) pairs, and put a record of each on
+    'results' as (code, time enqueued, time received, time the
+    pins were set, time the pins were reset, status). With
+    overlap = 'coalesce', when several codes are waiting, only
+    the newest is sent, and the others get the status
+    'coalesced', except for listening_codes, which are always
+    sent."""
+    send = trigger_sender(inpout32_addr, simulated_port)
+    ready_at = 0
+    stopping = False
+    held = None
+      # A listening code that was waiting behind the code being
+      # sent, with the time it was received.
+    while not stopping:
+        if held is not None:
+            item, received = held
+            held = None
+        else:
+            item = transport.get()
+            if item is None:
+                continue
+            received = monotonic()
+            if item[0] == STOP_WORKER:
+                return
+        # Leave the pins reset for trigger_code_delay after the
+        # last code.
+        precise_sleep(ready_at - monotonic())
+        if overlap == 'coalesce' and item[0] not in listening_codes:
+            while True:
+                newer = transport.get(False)
+                if newer is None:
+                    break
+                if newer[0] == STOP_WORKER:
+                    stopping = True
+                    break
+                if newer[0] in listening_codes:
+                    held = (newer, monotonic())
+                    break
+                results.put(item + (received, None, None, 'coalesced'))
+                item = newer
+                received = monotonic()
+        trigger_code, enqueued = item
         send(trigger_code)
-        sleep(trigger_code_delay)
+        pins_set = monotonic()
+        precise_sleep(pins_set + trigger_code_delay - monotonic())
         send(standard_actiview_trigger_codes['RESET_PINS'])
-        sleep(trigger_code_delay)
+        pins_reset = monotonic()
+        results.put((trigger_code, enqueued, received, pins_set, pins_reset, 'sent'))
+        ready_at = pins_reset + trigger_code_delay
+
+class TriggerLink(object):
+    """The Task's end of trigger_worker, which is run in its own
+    process, or in a thread if 'threaded' is true. 'transport' is
+    a key of trigger_transports. With overlap = 'reject', a code
+    sent while the previous one is probably still going out is
+    dropped with a warning instead of being queued, unless it's
+    one of listening_codes."""
+    def __init__(self, trigger_code_delay, inpout32_addr, overlap,
+            simulated_port = None, threaded = False, transport = 'queue'):
+        if threaded:
+            from Queue import Queue
+            from threading import Thread as Worker
+        else:
+            from multiprocessing import Queue, Process as Worker
+        self.trigger_code_delay = trigger_code_delay
+        self.overlap = overlap
+        self.transport = trigger_transports[transport](threaded)
+        self.results = Queue()
+        self.worker = Worker(
+            target = trigger_worker, args = (self.transport, self.results,
+                trigger_code_delay, inpout32_addr, overlap, simulated_port))
+        self.worker.daemon = threaded
+        self.worker.start()
+        self.enqueued = []
+          # (code, time enqueued) for each code put on the transport.
+        self.rejected = []
+        self.busy_until = 0
+
+    def send(self, code):
+        now = monotonic()
+        if self.overlap == 'reject':
+            if now < self.busy_until and code not in listening_codes:
+                warning('Trigger code {} rejected because code sending is busy'.format(code))
+                self.rejected.append((code, now, None, None, None, 'rejected'))
+                return
+            self.busy_until = max(now, self.busy_until) + 2 * self.trigger_code_delay
+        self.transport.put(code, now)
+        self.enqueued.append((code, now))
+
+    def close(self, join_timeout = 5):
+        """Stop the worker and return the records of all the codes
+        sent, in the order they were sent. If the worker has died
+        (say, because it couldn't open the port), the codes it
+        never reported on get the status 'unsent', so the caller
+        can still save its data."""
+        from Queue import Empty
+        self.transport.put(STOP_WORKER, monotonic())
+        # We have to drain 'results' before joining, or the
+        # worker may never finish.
+        records = []
+        while len(records) < len(self.enqueued):
+            try:
+                records.append(self.results.get(True, .1))
+            except Empty:
+                if not self.worker.is_alive():
+                    break
+        reported = set((r[0], r[1]) for r in records)
+        records.extend((code, enqueued, None, None, None, 'unsent')
+            for code, enqueued in self.enqueued
+            if (code, enqueued) not in reported)
+        self.worker.join(join_timeout)
+        if self.worker.is_alive() and hasattr(self.worker, 'terminate'):
+            warning('Trigger-code worker did not stop; terminating it')
+            self.worker.terminate()
+        return sorted(self.rejected + records, key = lambda r: r[1])
+
+# ------------------------------------------------------------
+# Headless mode
+# ------------------------------------------------------------
+
+class Headless(object):
+    """A stand-in for the display, the clock, and the subject, so
+    that a Task can be run without any of them. Pass one to Task
+    as 'headless'.
+
+    Time is virtual. It passes only when the Task flips the window
+    (by frame_period per flip) or waits, so a session runs as fast
+    as the CPU allows. Whenever the Task wants a response, it calls
+    responder(kind, dkey, choices), which should return a pair
+    (rt, response), meaning that the simulated subject responds
+    with 'response' after 'rt' seconds. The kinds are:
+
+    'button': 'choices' is a list of the strings of the buttons.
+      Respond with one of them.
+    'keypress': 'choices' is a list of the acceptable keys, or
+      None for any key. Respond with a key name, or with None to
+      wait for a CountdownTimer to run out.
+    'string': 'choices' is None. Respond with what the subject
+      types into the dialog box.
+    'questionnaire': 'choices' is a pair of a list of question IDs
+      and the number of scale levels. Respond with a dictionary
+      mapping IDs to levels, counting from 1.
+    'subject_id': 'choices' is None. Respond with the subject ID.
+
+    While the Task is running, the PsychoPy functions and classes
+    SchizoidPy uses are replaced with headless versions, as are
+    getTime and wait in psychopy.clock and psychopy.core, so
+    Clocks and CountdownTimers run on virtual time. So do the
+    monotonic clock and the wall clock that timestamps and
+    ('sys', 'clock') come from; the wall clock starts at the
+    real time. Scale screens
+    aren't supported."""
+    def __init__(self, responder, frame_period = 1/60., resolution = (1024, 768)):
+        self.responder = responder
+        self.frame_period = frame_period
+        self.resolution = resolution
+        self.now = 0.
+        self.flips = 0
+        self.pending = None
+        self.replaced = []
+
+    def install(self, task):
+        import psychopy.clock, psychopy.core
+        self.task = task
+        wall_zero = datetime.utcnow() - timedelta(seconds = self.now)
+          # Virtual time starts from the real wall-clock time.
+        def replace(namespace, name, value):
+            self.replaced.append((namespace, name, namespace[name]))
+            namespace[name] = value
+        for name, value in dict(
+                getTime = self.getTime, wait = self.wait,
+                monotonic_ns = lambda: int(round(self.now * 1e9)),
+                utcnow = lambda: wall_zero + timedelta(seconds = self.now),
+                getKeys = self.getKeys, clearEvents = self.clearEvents,
+                Window = lambda *a, **kw: HeadlessWindow(self),
+                Mouse = lambda *a, **kw: HeadlessMouse(self),
+                TextStim = NullStim, Rect = NullStim, Circle = NullStim,
+                BufferImageStim = NullStim).items():
+            replace(globals(), name, value)
+        for module in psychopy.clock, psychopy.core:
+            for name, value in ('getTime', self.getTime), ('wait', self.wait):
+                if name in vars(module):
+                    replace(vars(module), name, value)
+
+    def uninstall(self):
+        for namespace, name, value in reversed(self.replaced):
+            namespace[name] = value
+        self.replaced = []
+
+    def getTime(self):
+        return self.now
+
+    def wait(self, secs, hogCPUperiod = None):
+        self.now += max(secs, 0)
+
+    def flip(self):
+        self.flips += 1
+        self.now += self.frame_period
+        return self.now
+
+    def prompt(self, kind, dkey, choices):
+        """Get a response to be given through the keyboard or mouse
+        once its time comes."""
+        if kind == 'button':
+            self.buttons = dict((b.string, b) for b in reversed(choices))
+            choices = [b.string for b in choices]
+        rt, response = self.responder(kind, dkey, choices)
+        self.pending = (kind, self.now + rt, response)
+
+    def respond(self, kind, dkey, choices):
+        'Get a response to be given through a dialog box.'
+        rt, response = self.responder(kind, dkey, choices)
+        self.wait(rt)
+        return response
+
+    def due(self, kind):
+        return (self.pending is not None and self.pending[0] == kind and
+            self.now >= self.pending[1] and self.pending[2] is not None)
+
+    def getKeys(self, keyList = None):
+        if not self.due('keypress'):
+            return []
+        key = self.pending[2]
+        if keyList is not None and key not in keyList:
+            raise Exception('Headless response {!r} is not one of {!r}'.format(key, keyList))
+        self.pending = None
+        return [key]
+
+    def clearEvents(self, eventType = None):
+        pass
+
+class HeadlessWindow(object):
+    def __init__(self, headless):
+        self.headless = headless
+        self.size = headless.resolution
+        self.monitorFramePeriod = headless.frame_period
+        self.winHandle = NullStim()
+    def flip(self, clearBuffer = True):
+        return self.headless.flip()
+    def clearBuffer(self):
+        pass
+
+class HeadlessMouse(object):
+    def __init__(self, headless):
+        self.headless = headless
+    def getPressed(self):
+        return [1, 0, 0] if self.headless.due('button') else [0, 0, 0]
+    def getPos(self):
+        if not self.headless.due('button'):
+            return numpy.zeros(2)
+        b = self.headless.buttons[self.headless.pending[2]]
+        self.headless.pending = None
+        return numpy.array([b.x, b.y])
+    def setVisible(self, visible):
+        pass
+
+class NullStim(object):
+    """A stimulus that draws nothing. Any method whose name starts
+    with 'set' does nothing, too."""
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+    def draw(self):
+        pass
+    def __getattr__(self, name):
+        if name.startswith('set') or name == 'dispatch_events':
+            return lambda *a, **kw: None
+        raise AttributeError(name)
+
+class HeadlessInputCapture(object):
+    """An InputCapture for Headless. A response's event time is
+    exactly when the responder said it would happen."""
+    def __init__(self, headless):
+        self.headless = headless
+    def take(self):
+        h = self.headless
+        if h.due('keypress'):
+            _, t, key = h.pending
+            h.pending = None
+            return [('key', key, t)]
+        if h.due('button'):
+            _, t, string = h.pending
+            h.pending = None
+            b = h.buttons[string]
+            return [('mouse', numpy.array([b.x, b.y]), t)]
+        return []
+    def pump_until(self, deadline, interval):
+        # Virtual time only passes with flips, so there's nothing
+        # to gain by waiting.
+        return False
+    def clear(self):
+        pass
+    def close(self):
+        pass
+
+class HeadlessTriggerLink(object):
+    'Records trigger codes as sent instantly, on virtual time.'
+    def __init__(self, trigger_code_delay):
+        self.trigger_code_delay = trigger_code_delay
+        self.records = []
+    def send(self, code):
+        t = monotonic()
+        self.records.append((code, t, t, t, t + self.trigger_code_delay, 'sent'))
+    def close(self):
+        return self.records
+
+class RandomResponder(object):
+    """A responder for Headless that chooses among the choices
+    uniformly at random, after a log-normally distributed RT."""
+    def __init__(self, seed = None, median_rt = 1, rt_sigma = .5):
+        self.random = random.Random(seed)
+        self.median_rt = median_rt
+        self.rt_sigma = rt_sigma
+    def __call__(self, kind, dkey, choices):
+        rt = self.median_rt * math.exp(self.random.gauss(0, self.rt_sigma))
+        if kind == 'button':
+            return rt, self.random.choice(choices)
+        elif kind == 'keypress':
+            return rt, (
+                'space' if choices is None else
+                self.random.choice(choices) if choices else
+                None)
+        elif kind == 'string':
+            return rt, str(self.random.randint(0, 99))
+        elif kind == 'questionnaire':
+            ids, levels = choices
+            return rt, dict((i, self.random.randint(1, levels)) for i in ids)
+        else: # kind == 'subject_id'
+            return rt, 'simulated'
+
+class ScriptedResponder(object):
+    """A responder for Headless that gives a fixed list of
+    (rt, response) pairs in order, whatever it's asked."""
+    def __init__(self, responses):
+        self.responses = iter(responses)
+    def __call__(self, kind, dkey, choices):
+        return next(self.responses)
+
+default_headless = None
+  # Set this to make every new Task headless, such as when
+  # simulate-subjects.py runs a task program.
 
 # ------------------------------------------------------------
 # The Task class
@@ -314,12 +1656,165 @@ class Task(object):
               # or you'll forkbomb yourself.
             inpout32_addr = None,
             trigger_code_delay = .05, # Seconds
+            simulated_port = None,
+              # Set it to a filename to write trigger codes there,
+              # with timestamps, instead of to the parallel port.
+            trigger_worker_thread = False,
+              # Send trigger codes from a thread instead of a
+              # separate process.
+            trigger_transport = 'queue',
+              # How trigger codes get to the worker: through a
+              # multiprocessing 'queue', a 'pipe', or a ring buffer
+              # in shared memory ('shm'). Try trigger-test.py with
+              # --transport to see which is fastest on your
+              # machine.
+            trigger_overlap = 'queue',
+              # What to do with a trigger code sent while the
+              # previous one is still going out: 'queue' it,
+              # 'coalesce' all the waiting codes into the newest
+              # one, or 'reject' it with a warning. START_LISTENING
+              # and STOP_LISTENING are always sent. Either way,
+              # when each code was sent, set, and reset is saved
+              # under ('sys', 'triggers').
             pause_time = .1, # Seconds
             debug_log_dir = None,
               # Set it to a string to write a debug log. The
               # debug log will have similar information as the
               # final JSON output, but it's written line-by-line
               # so you can read it if the task program crashes.
+            monitor_socket = None,
+            monitor_capacity = 10000, # Records
+              # Set monitor_socket to the path of a Unix-domain socket
+              # to stream every save and trigger code there for
+              # monitor.py to show live. Sending never blocks.
+              # Records that can't be sent yet are buffered, up to
+              # monitor_capacity of them, and then dropped.
+            debug_log_capacity = 10000, # Records
+            debug_log_flush_interval = .5, # Seconds
+            debug_log_fsync_interval = 5, # Seconds
+              # The debug log is written by a background thread.
+              # These set how many records can wait to be written
+              # before the oldest are dropped, and how often the
+              # log is written out and synced to disk.
+            record_frames = False,
+              # Record the time of every flip during each screen
+              # that has a dkey, and save a summary of the
+              # inter-frame intervals and dropped frames under
+              # ('sys', 'frames', dkey).
+            flip_onsets = False,
+              # Save the onset of each screen that has a dkey as
+              # the time its first frame was flipped, instead of
+              # the time the screen method was called.
+            capture_input = False,
+              # Record key presses and mouse clicks as they're
+              # dispatched, so button_screen and keypress_screen
+              # can't miss a short click. Between frames, these
+              # screens dispatch input events every
+              # idle_poll_interval until input_poll_margin before
+              # the next flip is due, so the time of a response is
+              # known to within about idle_poll_interval instead
+              # of a frame. That time, and when the screen's loop
+              # noticed the response, relative to the screen's
+              # onset, are saved under ('sys', 'response_times',
+              # dkey).
+            input_poll_margin = .005, # Seconds
+              # How long before a flip is due to stop dispatching
+              # input events and start drawing. If drawing the
+              # screen takes longer than this, frames will be
+              # dropped.
+            frame_period = None, # Seconds
+              # The expected time between flips, for counting
+              # dropped frames. Defaults to what PsychoPy thinks
+              # the monitor's frame period is.
+            stimulus_cache_size = 0,
+              # Set it to a positive number to have 'text', 'html',
+              # and 'button' return the same object when called
+              # again with the same arguments, keeping at most
+              # this many stimuli around. Don't modify stimuli
+              # you get this way, or you'll change every later
+              # use of them, too.
+            cache_static_layer = False,
+              # Render the stimuli passed to 'showing' into a single
+              # texture, and draw that on each frame instead of
+              # the stimuli themselves. The texture is rebuilt
+              # whenever 'showing' or 'hiding' changes what's
+              # shown, so only use this if those stimuli don't
+              # otherwise change while they're shown.
+            idle_loops = False,
+              # In button_screen, scale_screen, and keypress_screen,
+              # only redraw the screen when something on it may
+              # have changed, and otherwise sleep for
+              # idle_poll_interval between checks for input,
+              # instead of redrawing as fast as possible.
+            idle_poll_interval = .001, # Seconds
+            record_cpu_time = False,
+              # Save the CPU time used during each screen that has
+              # a dkey under ('sys', 'cpu', dkey).
+            lazy_data = False,
+              # Make 'save' just append the dkey prefix, key, and
+              # value to a log, and build the nested structure of
+              # 'data' out of the log only when 'data' is used
+              # (e.g., by 'write'). This keeps the cost of each
+              # save constant, however deep the key, unless
+              # journal_dir, debug_log_dir, monitor_socket, or
+              # profile_screens is also set, since those need
+              # the whole key right away. 'save' still raises
+              # KeyError for a key that isn't a tuple or string,
+              # but a key that conflicts with an earlier save (as
+              # by indexing into a number) raises KeyError only
+              # when 'data' is built, naming the save.
+            journal_dir = None,
+            journal_checkpoint_interval = 1000, # Saves
+            journal_flush_interval = .5, # Seconds
+              # Set journal_dir to a string to write a journal of
+              # every save, one line of JSON apiece. If the task
+              # program crashes, recover-journal.py can rebuild
+              # the JSON output from the journal. The journal is
+              # written by a background thread every
+              # journal_flush_interval seconds, so if the whole
+              # process dies at once (as in a power cut), up to
+              # that many seconds of saves can be lost. Every
+              # journal_checkpoint_interval saves, it's fsynced
+              # and checkpointed (see Journal), so a crash can't
+              # take back saves from before that.
+            deferred_timestamps = False,
+              # Save timestamps as Timestamp objects, which hold
+              # raw readings of the monotonic clock, and only
+              # format them when the data is written (by 'write' or
+              # to the journal). Either way, timestamps come from
+              # the monotonic clock, with absolute ones computed
+              # from a wall-clock reading taken when the Task
+              # starts, so changes to the system time (as by NTP)
+              # don't affect them. Wall-clock readings from the
+              # start and from 'done' are saved under ('sys',
+              # 'clock').
+            compact_lists = False,
+              # Make the lists that 'save' creates to hold numbers,
+              # as for keys like ('rt', trial), TrialLists, which
+              # store them in NumPy arrays and aren't padded with
+              # Nones. They're written out as ordinary lists. This
+              # only pays off for data saved a field at a time,
+              # with long lists of numbers: they take a fraction of
+              # the memory, for a little more time per save. Lists
+              # of anything else, like the list of dictionaries
+              # made for keys like ('trial', i, 'rt'), stay
+              # ordinary lists.
+            profile_screens = False,
+              # Save, under ('sys', 'profile', dkey), how much
+              # wall-clock and CPU time each screen that takes
+              # a dkey spent drawing, polling for input, checking
+              # buttons, saving, sending trigger codes, and
+              # writing the debug log.
+            profile_session = False,
+              # Run the whole session under cProfile. 'write'
+              # writes the profile to write_path + '.prof', for
+              # pstats or a viewer like SnakeViz.
+              # With either profiling option, 'write' also writes
+              # a summary of hot spots to write_path + '.hotspots.txt'.
+            json_default = None,
+              # The default 'json_default' for 'write', which is
+              # also used for the journal. Values it can't encode
+              # are journaled as their reprs.
             double_draw = False,
               # Draw everything twice to work around
               # a graphics bug.
@@ -339,58 +1834,168 @@ class Task(object):
               # the dialog boxes appear on your system, not what
               # you want. It's used to position the boxes.
             font_name = 'Verdana',
-            html_font_size = 20): # Points
+            html_font_size = 20, # Points
+            batch_text = False,
+              # Draw all the stimuli made by 'text' and 'html' on
+              # the screen, including the labels of buttons, with
+              # a single pyglet Batch, which is rebuilt whenever
+              # the set of such stimuli changes. The text is drawn
+              # on top of all the other stimuli. Don't change text
+              # stimuli after making them if you use this.
+            prefetch_margin = .02, # Seconds
+              # Don't start a job queued with 'prefetch' when a wait
+              # has less than this much time left, so the job is
+              # unlikely to make the wait run long.
+            headless = None):
+              # Set it to a Headless to run without a display or
+              # a subject. Defaults to default_headless.
 
         vs = locals()
         del vs['self']
         for k, v in vs.items(): setattr(self, k, v)
 
+        self.session_profile = None
+        if self.profile_session:
+            import cProfile
+            self.session_profile = cProfile.Profile()
+            self.session_profile.enable()
+
+        if self.headless is None:
+            self.headless = default_headless
+        if self.headless is not None:
+            self.headless.install(self)
+
+        self.started_ns, self.started_wall = monotonic_ns(), utcnow()
+
         self.debug_log = None
         if self.debug_log_dir:
-            self.debug_log = open(
+            self.debug_log = DebugLog(
                 os.path.join(self.debug_log_dir, 'debuglog-{}.txt'.format(
                     datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S-%f'))),
-                'w',
-                buffering = 0)
-
-        self.data = {}
+                self.debug_log_capacity,
+                self.debug_log_flush_interval,
+                self.debug_log_fsync_interval)
+
+        self.publisher = None
+        if self.monitor_socket:
+            self.publisher = Publisher(self.monitor_socket,
+                self.monitor_capacity, self.json_or_repr)
+
+        self.journal = None
+        if self.journal_dir:
+            self.journal = Journal(
+                os.path.join(self.journal_dir, 'journal-{}.jsonl'.format(
+                    datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S-%f'))),
+                self.journal_checkpoint_interval,
+                self.journal_flush_interval,
+                self.json_or_repr)
+
+        self.data_tree = {}
+        self.save_log = [] if self.lazy_data else None
+        self.log_saves_directly = self.lazy_data and not (
+            self.journal or self.debug_log or self.publisher or
+            self.profile_screens)
+          # The journal, the debug log, the monitor, and the
+          # screen profiler all need 'store' to see every save.
         self.cur_dkey_prefix = ()
         self.implicitly_draw = []
-
-        if self.send_actiview_trigger_codes:
-            import multiprocessing
-            self.trigger_queue = multiprocessing.Queue()
-            self.trigger_worker = multiprocessing.Process(
-                target = trigger_worker, args = (self.trigger_queue, self.trigger_code_delay, inpout32_addr))
-            self.trigger_worker.start()
-            self.save(('sys', 'trigger_worker_pid'), self.trigger_worker.pid)
-            self.trigger(standard_actiview_trigger_codes['START_LISTENING'])
-
-        pyglet_screen = pyglet.window.get_platform().get_default_display().get_default_screen()
-        self.screen_width, self.screen_height = pyglet_screen.width, pyglet_screen.height
-        if self.shrink_screen:
-            self.screen_width -= 5
-            self.screen_height -= 5
-        self.win = Window((self.screen_width, self.screen_height),
-            monitor = 'testMonitor',
-            winType = 'pyglet', fullscr = False,
-            units = 'norm', color = bg_color)
-        self.mouse = Mouse(win = self.win)
-        self.fixation_cross = StimGroup((
-            Rect(self.win, fillColor = fixation_cross_color, lineColor = fixation_cross_color,
-                units = 'pix',
-                width = self.fixation_cross_length, height = self.fixation_cross_thickness),
-            Rect(self.win, fillColor = fixation_cross_color, lineColor = fixation_cross_color,
-                units = 'pix',
-                width = self.fixation_cross_thickness, height = self.fixation_cross_length)))
-
-        init_wx()
+        self.static_layer = None
+        self.screen_is_current = False
+        self.last_flip = None
+        self.frame_times = None
+        self.pending_onsets = []
+        self.pending_offsets = []
+        self.text_batch = None
+        self.text_batch_key = None
+        self.prefetch_jobs = OrderedDict()
+        self.prefetch_results = {}
+        self.stimulus_cache = (LRUCache(stimulus_cache_size)
+            if stimulus_cache_size
+            else None)
+
+        # The trigger-code worker is started first, so it can get
+        # ready (which, as a separate process, it does in
+        # parallel) while the window and the wx app are made. How
+        # long each step took is saved under ('sys', 'startup').
+        startup = {}
+        def timed(step, f, *args):
+            t = time()
+            value = f(*args)
+            startup[step] = time() - t
+            return value
+        started = time()
+        if self.send_actiview_trigger_codes and self.headless is not None:
+            self.trigger_link = HeadlessTriggerLink(self.trigger_code_delay)
+        elif self.send_actiview_trigger_codes:
+            self.trigger_link = timed('trigger_link', TriggerLink,
+                self.trigger_code_delay, inpout32_addr, self.trigger_overlap,
+                self.simulated_port, self.trigger_worker_thread,
+                self.trigger_transport)
+            if not self.trigger_worker_thread:
+                self.save(('sys', 'trigger_worker_pid'), self.trigger_link.worker.pid)
+
+        def make_window():
+            if self.headless is not None:
+                self.screen_width, self.screen_height = self.headless.resolution
+            else:
+                pyglet_screen = pyglet.window.get_platform().get_default_display().get_default_screen()
+                self.screen_width, self.screen_height = pyglet_screen.width, pyglet_screen.height
+            if self.shrink_screen:
+                self.screen_width -= 5
+                self.screen_height -= 5
+            self.win = Window((self.screen_width, self.screen_height),
+                monitor = 'testMonitor',
+                winType = 'pyglet', fullscr = False,
+                units = 'norm', color = bg_color)
+            self.mouse = Mouse(win = self.win)
+            self.input = (
+                None if not self.capture_input else
+                InputCapture(self.win) if self.headless is None else
+                HeadlessInputCapture(self.headless))
+            if self.frame_period is None:
+                self.frame_period = self.win.monitorFramePeriod
+            self.fixation_cross = StimGroup((
+                Rect(self.win, fillColor = fixation_cross_color, lineColor = fixation_cross_color,
+                    units = 'pix',
+                    width = self.fixation_cross_length, height = self.fixation_cross_thickness),
+                Rect(self.win, fillColor = fixation_cross_color, lineColor = fixation_cross_color,
+                    units = 'pix',
+                    width = self.fixation_cross_thickness, height = self.fixation_cross_length)))
+        timed('window', make_window)
+
+        if self.headless is None:
+            timed('wx', init_wx)
+
+        self.trigger(standard_actiview_trigger_codes['START_LISTENING'])
+        startup['total'] = time() - started
+        self.save(('sys', 'startup'), startup)
 
         self.save(('sys', 'hostname'), gethostname())
         self.save(('sys', 'resolution'), (self.screen_width, self.screen_height))
         self.save(('sys', 'pid'), os.getpid())
-
-        self.save(('overall_timing', 'started'), abs_timestamp_str())
+        if self.record_frames:
+            self.save(('sys', 'frame_period'), self.frame_period)
+
+        self.screen_profiler = None
+        if self.profile_screens:
+            self.screen_profiler = ScreenProfiler()
+            timed = self.screen_profiler.timed
+            # Wrap the methods of this instance only, so other
+            # Tasks aren't affected.
+            for name, phase in (
+                    ('draw', 'draw'), ('poll_events', 'input'),
+                    ('pressed_button', 'buttons'), ('store', 'save'),
+                    ('trigger', 'trigger')):
+                setattr(self, name, timed(phase, getattr(self, name)))
+            if self.debug_log is not None:
+                self.debug_log.log = timed('debug_log', self.debug_log.log)
+            for name in ('button_screen', 'scale_screen', 'keypress_screen',
+                    'string_entry_screen', 'questionnaire_screen'):
+                setattr(self, name,
+                    self.screen_profiler.screen(self, getattr(self, name)))
+
+        self.save(('overall_timing', 'started'),
+            self.started_wall.strftime("%Y-%m-%d %H:%M:%S.%f"))
 
     def save(self, key, value):
         """Set a value in data with Perl-style autovivification, so
@@ -398,31 +2003,34 @@ class Task(object):
         o.data['times'][3]['orange'] = 'x' but works even if the
         intermediate data structures don't exist yet (or, in the
         case of lists, are too short)."""
-        key = tuplecat(tuple(self.cur_dkey_prefix), key)
-        if isinstance(key, tuple):
-            seq = self.data
-            for k, next_k in staggered(key):
-                newobj = (
-                     value if next_k is None else
-                     [] if isinstance(next_k, int) else
-                     {}) # if isinstance(next_k, str)
-                if isinstance(seq, dict):
-                    if k not in seq:
-                        seq[k] = newobj
-                elif isinstance(seq, list):
-                    if len(seq) - 1 < k:
-                        # The list is too short. Pad it out with Nones.
-                        seq[len(seq):] = (k + 1 - len(seq)) * [None]
-                    if seq[k] is None:
-                        seq[k] = newobj
-                else: raise KeyError
-                seq = seq[k]
-        elif isinstance(key, str):
-            self.data[key] = value
-        else:
-            raise KeyError
-        if self.debug_log is not None:
-            print >>self.debug_log, 'Saved', repr(key), '|||', repr(value)
+        if self.log_saves_directly:
+            # Leave joining the key to the prefix for later, too.
+            if not self.cur_dkey_prefix and not isinstance(key, (tuple, str)):
+                raise KeyError
+            self.save_log.append((self.cur_dkey_prefix, key, value, monotonic_ns()))
+            return
+        self.store(tuplecat(self.cur_dkey_prefix, key), value)
+
+    @property
+    def data(self):
+        if self.save_log:
+            for i, (prefix, key, value, _) in enumerate(self.save_log):
+                key = tuplecat(prefix, key)
+                try:
+                    autovivify(self.data_tree, key, value, self.compact_lists)
+                except (KeyError, IndexError, TypeError):
+                    # Drop the bad save along with those already
+                    # replayed, so the next use of 'data' carries on
+                    # from the one after it.
+                    del self.save_log[:i + 1]
+                    raise KeyError('Entry {} of the save log, for {!r}, conflicts with an earlier save'.format(i, key))
+            del self.save_log[:]
+        return self.data_tree
+    @data.setter
+    def data(self, value):
+        self.data_tree = value
+        if self.save_log is not None:
+            del self.save_log[:]
 
     # The below are silly, I know, but
     #     with task.dkey_prefix("phooey"):
@@ -448,16 +2056,24 @@ class Task(object):
 
     def start_clock(self):
         self.clock = Clock()
+        self.clock_zero_ns = monotonic_ns()
 
     def set_pyglet_visible(self, visible = True):
         self.win.winHandle.set_visible(visible)
 
     def trigger(self, code):
         if self.send_actiview_trigger_codes and code is not None:
-            self.trigger_queue.put(code)
+            self.trigger_link.send(code)
+            if self.publisher is not None:
+                self.publisher.publish('trigger', code, monotonic())
+                  # A raw reading, since converting it with
+                  # time_value could start the clock.
 
     def get_subject_id(self, window_title):
-        dialog = psychopy.gui.wxgui.Dlg(title = window_title)
+        if self.headless is not None:
+            self.save('subject', self.headless.respond('subject_id', 'subject', None))
+            return
+        dialog = Dlg(title = window_title)
         dialog.addText('')
         dialog.addField('Subject ID:', 'test')
         dialog.addText('')
@@ -467,53 +2083,74 @@ class Task(object):
 
     def pause(self, timer = None):
         if timer is None:
-            wait(self.pause_time)
+            self.idle_wait(self.pause_time)
         elif timer.getTime() > 0:
-            wait(min(timer.getTime(), self.pause_time))
+            self.idle_wait(min(timer.getTime(), self.pause_time))
+
+    def prefetch(self, key, make):
+        """Queue make(), a function that makes a stimulus or a list
+        of stimuli for an upcoming screen, to be called during the
+        waits of wait_screen, wait_screen_till, and pause. Each
+        stimulus is then drawn once off-screen, so its text is laid
+        out and its textures are uploaded before it's really shown.
+        Get what make() returned with 'prefetched'."""
+        self.prefetch_jobs[key] = make
+
+    def prefetched(self, key):
+        """Return what the 'make' passed to 'prefetch' for 'key'
+        returned, calling it now if no wait has done so yet. The
+        seconds spent preparing the stimuli during waits ('hidden')
+        and here ('critical') are saved under ('sys', 'prefetch',
+        key)."""
+        if key in self.prefetch_jobs:
+            self.prefetch_now(key, self.prefetch_jobs.pop(key), False)
+        value, seconds, hidden = self.prefetch_results.pop(key)
+        with self.dkey_prefix(('sys', 'prefetch')):
+            self.save(key, dict(
+                hidden = seconds if hidden else 0,
+                critical = 0 if hidden else seconds))
+        return value
 
     def text(self, x, y, string, hAlign = 'center', vAlign = 'center', wrap = None, color = 'black', height = .075):
-        return TextStim(self.win,
-            text = string, pos = (x, y), color = color,
-            height = height, font = self.font_name,
-            alignHoriz = hAlign, alignVert = vAlign,
-            wrapWidth = wrap)
+        return self.memoize(
+            ('text', x, y, string, hAlign, vAlign, wrap,
+                hashable(color), height, self.font_name),
+            lambda: self.new_text(x, y, string, hAlign, vAlign, wrap, color, height))
 
     def html(self, x, y, string, hAlign = 'center', vAlign = 'center', wrap = None, color = 'black', font_size = None):
-        # Note that when hAlign = 'center', the stimuli generated
-        # with this method, unlike task.text(), are centered with
-        # respect to the entire wrap width, not their actual content
-        # width. I failed to fix this.
-        text = self.text(x, y, string, hAlign, vAlign, wrap, color)
-        if hAlign == 'right':
-           raise Exception('Not implemented: hAlign = "right"')
-        pyg = pyglet.text.HTMLLabel(
-            #x = self.screen_width/2,
-            text = text.text,# if hAlign == 'left' else
-                   #'<center>{}</center>'.format(text.text),
-            #anchor_x = text.alignHoriz,
-            anchor_y = text.alignVert,
-            multiline = True, width = text._wrapWidthPix)
-        #if hAlign == 'center':
-        #    print pyg.content_width, "vs.", pyg.width
-        #    pyg.x = (text._wrapWidthPix - pyg.content_width)/2
-        pyg.font_name = self.font_name
-        pyg.font_size = font_size if font_size is not None else self.html_font_size
-        text._pygletTextObj = pyg
-        return text
-        
+        return self.memoize(
+            ('html', x, y, string, hAlign, vAlign, wrap,
+                hashable(color), font_size, self.font_name, self.html_font_size),
+            lambda: self.new_html(x, y, string, hAlign, vAlign, wrap, color, font_size))
+
     def button(self, x, y, string, trigger_code = None, keybinding = None):
-        return Button(self, x, y, string, trigger_code, keybinding)
+        b = self.memoize(
+            ('button', x, y, string, trigger_code, keybinding,
+                self.button_radius, self.font_name),
+            lambda: Button(self, x, y, string, trigger_code, keybinding))
+        b.was_pressed = False
+        return b
 
     def wait_screen(self, time_to_wait, *stimuli):
         'Display some stimuli for a given amount of time.'
         self.draw(*stimuli)
-        wait(time_to_wait)
+        self.idle_wait(time_to_wait)
+
+    def frame_screen(self, dkey, n_frames, *stimuli):
+        """Display some stimuli for exactly n_frames frames. The
+        saved onset is when the first frame was flipped, and the
+        offset is when the next frame after the last was flipped,
+        by whatever screen comes next. The requested and achieved
+        durations are saved under ('sys', 'durations', dkey)."""
+        with timestamps(self, dkey, n_frames):
+            for _ in range(n_frames):
+                self.draw(*stimuli)
 
     def wait_screen_till(self, timer, *stimuli):
         'Display some stimuli until the CountdownTimer reaches 0.'
         if timer.getTime() > 0:
             self.draw(*stimuli)
-            wait(timer.getTime())
+            self.idle_wait(timer.getTime())
 
     def okay_screen(self, dkey, *stimuli):
         self.button_screen(dkey, *(stimuli + (self.button(
@@ -533,13 +2170,20 @@ class Task(object):
         until the subject presses a button. Return the pressed
         button's string."""
         buttons = [x for x in stimuli if isinstance(x, Button)]
-        clearEvents()
-        with self.timestamps(dkey):
-            while all([not x.activated() for x in buttons]):
-                if getKeys(['escape']): exit()
-                clearEvents()
-                self.draw(*stimuli)
-        val = [x for x in buttons if x.activated()][0].string
+        centers = numpy.array([(b.x, b.y) for b in buttons], dtype = float)
+        radii = numpy.array([b.radius for b in buttons], dtype = float)
+        self.clear_input()
+        if self.headless is not None:
+            self.headless.prompt('button', dkey, buttons)
+        self.screen_is_current = False
+        with self.timestamps(dkey) as ts:
+            while True:
+                pressed, event_time = self.pressed_button(buttons, centers, radii)
+                if pressed is not None:
+                    break
+                self.refresh(stimuli, pump_input = True)
+            self.save_response_time(dkey, ts, event_time)
+        val = pressed.string
         if len(buttons) > 1:
           # No sense in saving the value of the button if there's
           # only one.
@@ -550,11 +2194,26 @@ class Task(object):
     def scale_screen(self, dkey, *stimuli):
         """Display some stimuli (including at least one scale) until
         the subject has responded to all the scales."""
+        if self.headless is not None:
+            raise Exception('Not implemented: headless scale_screen')
         scales = filter(lambda x: isinstance(x, RatingScale), stimuli)
         clearEvents()
+        self.screen_is_current = False
+        last_mouse = None
         with self.timestamps(dkey):
             while any([x.noResponse for x in scales]):
-                self.draw(*stimuli)
+                changed = False
+                if self.idle_loops:
+                    # A scale only changes in response to the mouse
+                    # or the keyboard, so redraw it only when the
+                    # mouse has moved or is held down, or keys are
+                    # waiting for the scale to read them.
+                    self.win.winHandle.dispatch_events()
+                    mouse = (tuple(self.mouse.getPos()), tuple(self.mouse.getPressed()))
+                    changed = (mouse != last_mouse or any(mouse[1])
+                        or bool(psychopy_event._keyBuffer))
+                    last_mouse = mouse
+                self.refresh(stimuli, changed)
         rs = [x.getRating() for x in scales]
         self.save(dkey, rs[0] if len(rs) == 1 else rs)
 
@@ -599,21 +2258,33 @@ class Task(object):
                    return
                break
 
-        clearEvents()
+        self.clear_input()
+        if self.headless is not None:
+            self.headless.prompt('keypress', dkey,
+                None if checkfor is None else
+                [k for k in checkfor if k != 'escape'])
+        self.screen_is_current = False
         v = None
-        with self.timestamps(dkey):
+        with self.timestamps(dkey) as ts:
             while True:
                 if timer is not None and timer.getTime() <= 0:
                    use_key(timer)
                    return
-                pressed = getKeys(checkfor)
-                clearEvents()
+                events = [(k, t)
+                    for kind, k, t in self.poll_events(checkfor)
+                    if kind == 'key' and (checkfor is None or k in checkfor)]
+                if self.input is not None:
+                    # Captured keys come with their own times, so
+                    # there's no ambiguity in taking the first.
+                    events = events[:1]
+                pressed = [k for k, t in events]
                 if 'escape' in pressed:
                     exit()
                 if len(pressed) == 1:
+                    self.save_response_time(dkey, ts, events[0][1])
                     v = use_key(pressed[0])
                     break
-                self.draw(*stimuli)
+                self.refresh(stimuli, pump_input = True)
 
         return v
 
@@ -632,6 +2303,17 @@ class Task(object):
         with self.timestamps(dkey):
             trying_again = False
             while True:
+                if self.headless is not None:
+                    inp = self.headless.respond('string', dkey, None)
+                    if trim:
+                        inp = inp.strip()
+                    if not accept_blank and (inp.isspace() or inp == ''):
+                        continue
+                    inp = extractor(inp)
+                    if inp is not None:
+                        self.save(dkey, inp)
+                        break
+                    continue
                 dialog = SchizoidDlg(
                     title = 'Entry',
                     pos = (
@@ -676,25 +2358,31 @@ class Task(object):
     def questionnaire_screen(self, dkey, string, scale_levels,
             questions, questions_per_page = 8,
             column_filler_width = 100, font_size = None,
-            prompt_color = 'black'):
-        qd = QuestionnaireDialog(None, '', scale_levels,
-            questions, questions_per_page, font_size,
-            column_filler_width)
+            prompt_color = 'black', prebuild_pages = True):
         prompt = self.text(0, .9, string,
             vAlign = 'top', wrap = 1.5, color = prompt_color)
+        if self.headless is not None:
+            with self.timestamps(dkey):
+                self.draw(prompt)
+                responses = self.headless.respond('questionnaire', dkey, (
+                    [q['id'] for q in questions]
+                      if isinstance(questions[0], dict)
+                      else range(len(questions)),
+                    len(scale_levels)))
+            for k, v in responses.items():
+                self.save(tuplecat(dkey, k), v)
+            return
+        qd = QuestionnaireDialog(None, '', scale_levels,
+            questions, questions_per_page, font_size,
+            column_filler_width, prebuild_pages)
         with self.timestamps(dkey):
             while True:
                 self.draw(prompt)
                 qd.CenterOnScreen(wx.BOTH)
                 qd.ShowModal()
-                responses = {}
-                for q in qd.questions:
-                    vs = [x.GetValue() for x in q['buttons']]
-                    if not any(vs): break
-                    responses[q['id']] = vs.index(True) + 1
-                else:
-                    for k, v in responses.items():
-                        self.save(tuplecat(dkey, k), v)
+                if qd.responses.all():
+                    for q, v in zip(qd.questions, qd.responses):
+                        self.save(tuplecat(dkey, q['id']), int(v))
                     qd.Destroy()
                     return
                 self.draw(prompt)
@@ -705,40 +2393,323 @@ class Task(object):
                 dialog.show()
 
     def write(self, write_path, json_default = None):
-        with open(write_path, "w") as out:
-            json.dump(self.data, out, sort_keys = True, indent = 2,
-                default = json_default)
-            print >>out
+        if json_default is None:
+            json_default = self.json_default
+        write_data(self.data, write_path,
+            lambda x: self.json_value(x, json_default))
+        if self.session_profile is not None:
+            self.session_profile.dump_stats(write_path + '.prof')
+        if self.screen_profiler is not None or self.session_profile is not None:
+            write_hotspots(write_path + '.hotspots.txt',
+                self.screen_profiler, self.session_profile)
 
     def done(self):
-    # We avoid self.save here in case we're inside a "with o.dkey_prefix".
+    # We use self.store instead of self.save here in case we're
+    # inside a "with o.dkey_prefix".
         # Kill the trigger-code worker.
         if self.send_actiview_trigger_codes:
             self.trigger(standard_actiview_trigger_codes['STOP_LISTENING'])
-            self.trigger_queue.put(PoisonPill)
-            self.trigger_worker.join()
+            self.store(('sys', 'triggers'), [
+                dict(code = code, status = status,
+                    enqueued = self.time_value(enqueued),
+                    received = self.time_value(received),
+                    pins_set = self.time_value(pins_set),
+                    pins_reset = self.time_value(pins_reset))
+                for code, enqueued, received, pins_set, pins_reset, status
+                in self.trigger_link.close()])
+        for ts in self.pending_offsets: ts.flipped_off(monotonic())
+        self.pending_offsets = []
+        if self.stimulus_cache is not None:
+            self.store(('sys', 'stimulus_cache'), self.stimulus_cache.stats())
         # Save the time.
+        done_ns, done_wall = monotonic_ns(), utcnow()
         if hasattr(self, 'clock'):
-            self.data['overall_timing']['clock_duration'] = self.clock.getTime()
-        self.data['overall_timing']['done'] = abs_timestamp_str()
+            self.store(('overall_timing', 'clock_duration'),
+                (done_ns - self.clock_zero_ns) / 1e9)
+        self.store(('overall_timing', 'done'), done_wall.strftime("%Y-%m-%d %H:%M:%S.%f"))
+        self.store(('sys', 'clock'), dict(
+            started_ns = self.started_ns,
+            started_wall = self.started_wall.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            done_ns = done_ns,
+            done_wall = done_wall.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            drift = (done_wall - self.started_wall).total_seconds()
+                - (done_ns - self.started_ns) / 1e9))
+              # How far the wall clock moved relative to the
+              # monotonic clock during the session.
+        if self.debug_log is not None:
+            self.store(('sys', 'debug_log'), self.debug_log.stats())
+        if self.publisher is not None:
+            self.store(('sys', 'monitor'), self.publisher.stats())
+            self.publisher.publish('done')
+            self.publisher.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.debug_log is not None:
+            self.debug_log.close()
+        if self.input is not None:
+            self.input.close()
+        if self.headless is not None:
+            self.headless.uninstall()
+        if self.session_profile is not None:
+            self.session_profile.disable()
 
     #####################
     # Private
     #####################
 
-    def save_timestamp(self, dkey, i):
+    def time_value(self, t):
+        """Convert 't', a value of monotonic(), to what save_timestamp
+        would have saved at that moment."""
+        if t is None:
+            return None
+        return self.timestamp_value(int(round(t * 1e9)))
+
+    def timestamp_value(self, ns):
         if not self.absolute_timestamps and not hasattr(self, 'clock'):
             self.start_clock()
-        with self.dkey_prefix('times'):
-            self.save(tuplecat(dkey, i),
-                abs_timestamp_str()
-                    if self.absolute_timestamps
-                    else self.clock.getTime())
+        zero = None if self.absolute_timestamps else self.clock_zero_ns
+        return (Timestamp(ns, zero)
+            if self.deferred_timestamps
+            else self.format_time(ns, zero))
+
+    def format_time(self, ns, zero):
+        if zero is not None:
+            return (ns - zero) / 1e9
+        return (self.started_wall + timedelta(
+            microseconds = (ns - self.started_ns) // 1000)
+            ).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    def json_value(self, x, json_default):
+        if isinstance(x, Timestamp):
+            return self.format_time(x.ns, x.zero)
+        if isinstance(x, TrialList):
+            return x.tolist()
+        if json_default is not None:
+            return json_default(x)
+        raise TypeError(repr(x) + ' is not JSON serializable')
+
+    def json_or_repr(self, x):
+        try:
+            return self.json_value(x, self.json_default)
+        except TypeError:
+            return repr(x)
+
+    def save_timestamp(self, dkey, i):
+        self.store(self.timestamp_key(dkey, i),
+            self.timestamp_value(monotonic_ns()))
+
+    def timestamp_key(self, dkey, i):
+        return tuplecat(tuplecat('times', self.cur_dkey_prefix), tuplecat(dkey, i))
+
+    def store(self, key, value):
+        'Like save, but ignoring the dkey prefix.'
+        if self.save_log is not None:
+            if not isinstance(key, (tuple, str)):
+                raise KeyError
+            self.save_log.append(((), key, value, monotonic_ns()))
+        else:
+            autovivify(self.data_tree, key, value, self.compact_lists)
+        if self.journal is not None:
+            self.journal.record(key, value)
+        if self.debug_log is not None:
+            self.debug_log.log(key, value)
+        if self.publisher is not None:
+            self.publisher.publish('save', key, value)
+
+    def memoize(self, key, make):
+        if self.stimulus_cache is None:
+            return make()
+        return self.stimulus_cache.get(key, make)
+
+    def new_text(self, x, y, string, hAlign = 'center', vAlign = 'center', wrap = None, color = 'black', height = .075):
+        text = TextStim(self.win,
+            text = string, pos = (x, y), color = color,
+            height = height, font = self.font_name,
+            alignHoriz = hAlign, alignVert = vAlign,
+            wrapWidth = wrap)
+        text.batch_args = ('text', x, y, string, hAlign, vAlign, self.font_name, height)
+        return text
+
+    def new_html(self, x, y, string, hAlign, vAlign, wrap, color, font_size):
+        # Note that when hAlign = 'center', the stimuli generated
+        # with this method, unlike task.text(), are centered with
+        # respect to the entire wrap width, not their actual content
+        # width. I failed to fix this.
+        text = self.new_text(x, y, string, hAlign, vAlign, wrap, color)
+        if hAlign == 'right':
+           raise Exception('Not implemented: hAlign = "right"')
+        if self.headless is not None:
+            return text
+        pyg = pyglet.text.HTMLLabel(
+            #x = self.screen_width/2,
+            text = text.text,# if hAlign == 'left' else
+                   #'<center>{}</center>'.format(text.text),
+            #anchor_x = text.alignHoriz,
+            anchor_y = text.alignVert,
+            multiline = True, width = text._wrapWidthPix)
+        #if hAlign == 'center':
+        #    print pyg.content_width, "vs.", pyg.width
+        #    pyg.x = (text._wrapWidthPix - pyg.content_width)/2
+        pyg.font_name = self.font_name
+        pyg.font_size = font_size if font_size is not None else self.html_font_size
+        text._pygletTextObj = pyg
+        text.batch_args = ('html', x, y, string, hAlign, vAlign,
+            pyg.font_name, pyg.font_size)
+        return text
+
+    def idle_wait(self, secs):
+        'Wait for secs seconds, running prefetch jobs meanwhile.'
+        deadline = getTime() + secs
+        self.frames_paused()
+        while self.prefetch_jobs and deadline - getTime() > self.prefetch_margin:
+            key, make = self.prefetch_jobs.popitem(last = False)
+            self.prefetch_now(key, make, True)
+        wait(deadline - getTime())
+
+    def prefetch_now(self, key, make, hidden):
+        t = time()
+        value = make()
+        for s in value if isinstance(value, (list, tuple)) else (value,):
+            s.draw()
+        self.win.clearBuffer()
+        self.prefetch_results[key] = (value, time() - t, hidden)
+
+    def clear_input(self):
+        clearEvents()
+        if self.input is not None:
+            self.input.clear()
+
+    def save_response_time(self, dkey, ts, event_time):
+        """Save when the response happened and when it was noticed,
+        relative to the onset of the screen timed by 'ts'."""
+        if self.input is None:
+            return
+        onset = ts.onset if ts.onset is not None else ts.entered
+        with self.dkey_prefix(('sys', 'response_times')):
+            self.save(dkey, dict(
+                event = None if event_time is None else event_time - onset,
+                detected = monotonic() - onset))
+
+    def pressed_button(self, buttons, centers, radii):
+        '''Check the keyboard and mouse once and return the first of
+        'buttons' that has been pressed, or None, along with when
+        the press happened, if input is being captured. 'centers'
+        and 'radii' are arrays of the buttons' positions and sizes,
+        so all the buttons can be hit-tested at once.'''
+        for b in buttons:
+            if b.was_pressed:
+                return b, None
+        events = self.poll_events(mouse = True)
+        if any(kind == 'key' and x == 'escape' for kind, x, t in events):
+            exit()
+        for kind, x, t in events:
+            if kind == 'mouse':
+                hits = numpy.sum((centers - x) ** 2, axis = 1) <= radii ** 2
+            for i, b in enumerate(buttons):
+                if (hits[i] if kind == 'mouse' else b.keybinding == x):
+                    b.press()
+                    return b, t
+        return None, None
+
+    def poll_events(self, keyList = None, mouse = False):
+        """Return the keyboard (and, if 'mouse' is true, mouse)
+        events since the last call, as InputCapture.take does.
+        Without capture_input, they come from polling PsychoPy, so
+        they have no times, and a mouse button that's down counts
+        as a click where the mouse is."""
+        if self.input is not None:
+            events = self.input.take()
+        else:
+            events = [('key', k, None) for k in getKeys(keyList)]
+            if mouse and any(self.mouse.getPressed()):
+                events.append(('mouse', self.mouse.getPos(), None))
+        clearEvents()
+        return events
+
+    def save_frame_summary(self, dkey, flip_times):
+        with self.dkey_prefix(('sys', 'frames')):
+            self.save(dkey, frame_summary(flip_times, self.frame_period))
+
+    def frames_paused(self):
+        '''Note that the window won't be flipped for a while, so
+        the wait before the next flip isn't counted as dropped
+        frames.'''
+        if self.frame_times and self.frame_times[-1] is not None:
+            self.frame_times.append(None)
+
+    def implicitly_draw_changed(self):
+        self.static_layer = None
+        self.screen_is_current = False
+
+    def refresh(self, stimuli, changed = False, pump_input = False):
+        '''Draw a frame of a response loop. With idle_loops, the
+        screen is only redrawn when it's new or 'changed' is true;
+        otherwise, we sleep briefly instead. With 'pump_input' and
+        capture_input, input events are dispatched until the next
+        flip is nearly due, and if one comes in, we return without
+        drawing, so the loop can check it right away.'''
+        if changed or not self.idle_loops or not self.screen_is_current:
+            if (pump_input and self.input is not None
+                    and self.screen_is_current
+                    and self.input.pump_until(
+                        self.last_flip + self.frame_period - self.input_poll_margin,
+                        self.idle_poll_interval)):
+                return
+            self.draw(*stimuli)
+            self.screen_is_current = True
+        else:
+            self.frames_paused()
+            wait(self.idle_poll_interval, 0)
+
+    def batched(self, implicit, stimuli):
+        """Split the text out of 'implicit' and 'stimuli', and return
+        what's left of each along with a TextBatch of the text."""
+        def split(stimuli):
+            other, text = [], []
+            for s in stimuli:
+                if isinstance(s, Button):
+                    other.append(s.circle)
+                    s = s.text
+                (text if hasattr(s, 'batch_args') else other).append(s)
+            return other, text
+        implicit, implicit_text = split(implicit)
+        stimuli, text = split(stimuli)
+        text = implicit_text + text
+        key = tuple(map(id, text))
+        if key != self.text_batch_key:
+            if self.text_batch is not None:
+                self.text_batch.delete()
+            self.text_batch = TextBatch(self.win, text) if text else None
+            self.text_batch_key = key
+        return implicit, stimuli, self.text_batch
+
+    def implicit_layer(self):
+        if not self.cache_static_layer or not self.implicitly_draw:
+            return self.implicitly_draw
+        if self.static_layer is None:
+            self.static_layer = (
+                BufferImageStim(self.win, stim = self.implicitly_draw),)
+        return self.static_layer
 
     def draw(self, *stimuli):
-        for s in self.implicitly_draw: s.draw()
+        implicit = self.implicit_layer()
+        text_batch = None
+        if self.batch_text and self.headless is None:
+            implicit, stimuli, text_batch = self.batched(implicit, stimuli)
+        for s in implicit: s.draw()
         for s in stimuli: s.draw()
+        if text_batch: text_batch.draw()
         if self.double_draw:
-            for s in self.implicitly_draw: s.draw()
+            for s in implicit: s.draw()
             for s in stimuli: s.draw()
+            if text_batch: text_batch.draw()
         self.win.flip()
+        t = self.last_flip = monotonic()
+        if self.frame_times is not None:
+            self.frame_times.append(t)
+        if self.pending_offsets:
+            for ts in self.pending_offsets: ts.flipped_off(t)
+            self.pending_offsets = []
+        if self.pending_onsets:
+            for ts in self.pending_onsets: ts.flipped_on(t)
+            self.pending_onsets = []
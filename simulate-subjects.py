@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# encoding: UTF-8
+
+"""Run a task program many times over with simulated subjects,
+to check that it produces well-formed data for every branch.
+
+Each subject runs in its own process with a headless Task (see
+schizoidpy.Headless) that responds at random, seeded with the
+subject's number plus --seed. The task program's own 'random' and
+'numpy.random' are seeded the same way. Each subject's data is
+written to OUT/subject-N.json, and the task program runs with
+OUT/subject-N as its working directory, so whatever files it
+writes stay out of the way. Then a report is printed of failures,
+run times, and how many subjects saved each dkey (with list
+indices replaced by '*')."""
+
+import os
+import sys
+import json
+import random
+import argparse
+import traceback
+import multiprocessing
+from time import time
+import numpy
+import runpy
+import schizoidpy
+
+def run_subject(job):
+    script, out_dir, subject, seed = job
+    work_dir = os.path.join(out_dir, 'subject-{}'.format(subject))
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    os.chdir(work_dir)
+    random.seed(seed)
+    numpy.random.seed(seed)
+    headless = schizoidpy.Headless(schizoidpy.RandomResponder(seed))
+    schizoidpy.default_headless = headless
+    # Set up the script's environment as if it were run directly,
+    # so it can import modules that sit beside it and read its
+    # own sys.argv.
+    sys.path.insert(0, os.path.dirname(script))
+    sys.argv = [script]
+    error = None
+    started = time()
+    try:
+        runpy.run_path(script, run_name = '__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error = traceback.format_exc()
+    except Exception:
+        error = traceback.format_exc()
+    elapsed = time() - started
+    headless.uninstall()
+    task = getattr(headless, 'task', None)
+    keys = []
+    if task is None:
+        error = error or 'No Task was created.'
+    else:
+        try:
+            task.write(os.path.join(out_dir, 'subject-{}.json'.format(subject)))
+        except Exception:
+            error = error or traceback.format_exc()
+        keys = sorted(set(
+            '/'.join('*' if isinstance(k, int) else unicode(k) for k in key)
+            for key, _ in schizoidpy.flatten(task.data)))
+    return dict(subject = subject, seed = seed, error = error,
+        elapsed = elapsed, virtual_time = headless.now,
+        flips = headless.flips, keys = keys)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('script', help = 'the task program')
+    parser.add_argument('-n', '--subjects', type = int, default = 100)
+    parser.add_argument('-j', '--jobs', type = int,
+        default = multiprocessing.cpu_count(),
+        help = 'how many subjects to run at once (default: one per core)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('-o', '--out', default = 'simulated',
+        help = 'where to put the output (default: ./simulated)')
+    parser.add_argument('--json', metavar = 'FILE',
+        help = 'also write the report to FILE as JSON')
+    args = parser.parse_args()
+
+    script = os.path.abspath(args.script)
+    out_dir = os.path.abspath(args.out)
+    pool = multiprocessing.Pool(args.jobs, maxtasksperchild = 1)
+      # A fresh process for each subject, so nothing one task
+      # program does can leak into the next.
+    results = pool.map(run_subject,
+        [(script, out_dir, i, args.seed + i) for i in range(args.subjects)],
+        chunksize = 1)
+    pool.close()
+    pool.join()
+
+    failures = [r for r in results if r['error']]
+    coverage = {}
+    for r in results:
+        for k in r['keys']:
+            coverage[k] = coverage.get(k, 0) + 1
+    elapsed = numpy.array([r['elapsed'] for r in results])
+    print '{} subjects, {} failed'.format(len(results), len(failures))
+    for r in failures:
+        print
+        print 'Subject {} (seed {}):'.format(r['subject'], r['seed'])
+        print r['error'].rstrip()
+    print
+    print 'Run time (s): median {:.3f}, p95 {:.3f}, max {:.3f}, total {:.1f}'.format(
+        numpy.median(elapsed), numpy.percentile(elapsed, 95),
+        elapsed.max(), elapsed.sum())
+    print 'Virtual session time (s): median {:.1f}'.format(
+        numpy.median([r['virtual_time'] for r in results]))
+    print
+    print 'Subjects saving each dkey:'
+    for k in sorted(coverage):
+        print '  {:6} {}{}'.format(coverage[k], k,
+            '' if coverage[k] == len(results) else '  (partial)')
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(dict(results = results, coverage = coverage), out,
+                sort_keys = True, indent = 2)
+            print >>out
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,101 @@
 #!/usr/bin/python
+# encoding: UTF-8
 
-import time
+"""Check whether SchizoidPy's method of sending EEG trigger codes
+works on your system, and measure how well it works.
 
-standard_actiview_trigger_codes = dict(
-    START_LISTENING = 255,
-    STOP_LISTENING = 256,
-    RESET_PINS = 0)
-trigger_code_delay = .05 # Seconds
+By default, codes go out through the parallel port, just as they
+do from a Task. With --simulate, they're written with timestamps
+to a file instead, so the benchmark can run on any machine. Give
+--delay, --worker, and --transport more than once to compare configurations."""
 
-inpout32_addr = 888
+import os
+import json
+import argparse
+from time import sleep
+import numpy
+from schizoidpy import TriggerLink, trigger_transports, \
+    standard_actiview_trigger_codes
 
-wait = time.sleep
+def distribution(xs):
+    xs = numpy.array(xs)
+    if not len(xs):
+        return None
+    return dict(zip(
+        ('min', 'median', 'p95', 'p99', 'max'),
+        numpy.percentile(xs, [0, 50, 95, 99, 100]).tolist()))
 
-if inpout32_addr is not None:
-    from ctypes import windll
-    send = lambda x: windll.inpout32.Out32(inpout32_addr, x)
-else:
-    from psychopy.parallel import setData
-    send = setData
+def run(args, delay, worker, transport):
+    link = TriggerLink(delay, args.inpout32_addr, args.overlap,
+        args.simulate, worker == 'thread', transport)
+    link.send(standard_actiview_trigger_codes['START_LISTENING'])
+    for x in range(args.codes):
+        sleep(args.interval)
+        link.send(x + 1)
+    sleep(args.interval)
+    link.send(standard_actiview_trigger_codes['STOP_LISTENING'])
+    records = link.close()
+    sent = [r for r in records if r[5] == 'sent']
+    return dict(
+        delay = delay,
+        worker = worker,
+        transport = transport,
+        overlap = args.overlap,
+        codes = len(records),
+        sent = len(sent),
+        throughput = len(sent) / (sent[-1][4] - records[0][1])
+            if sent else 0, # Codes per second
+        wakeup = distribution([r[2] - r[1] for r in sent]),
+        latency = distribution([r[3] - r[1] for r in sent]),
+        pulse_width = distribution([r[4] - r[3] for r in sent]))
 
-def trigger(trigger_code):
-    print "Sending", trigger_code
-    send(trigger_code)
-    wait(trigger_code_delay)
-    print "Sending", standard_actiview_trigger_codes['RESET_PINS']
-    send(standard_actiview_trigger_codes['RESET_PINS'])
-    wait(trigger_code_delay)
+def ms(d, k):
+    return '{:8.3f}'.format(1000 * d[k]) if d else '     n/a'
 
-trigger(standard_actiview_trigger_codes['START_LISTENING'])
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--inpout32-addr', type = int,
+        default = 888 if os.name == 'nt' else None,
+        help = 'port address for inpout32 (default: 888 on Windows; elsewhere, use psychopy.parallel)')
+    parser.add_argument('--simulate', metavar = 'FILE',
+        help = 'write codes to FILE instead of the parallel port')
+    parser.add_argument('--delay', type = float, action = 'append',
+        help = 'trigger_code_delay, in seconds (default: .05)')
+    parser.add_argument('--worker', choices = ('process', 'thread'), action = 'append',
+        help = 'where trigger_worker runs (default: process)')
+    parser.add_argument('--transport', choices = sorted(trigger_transports), action = 'append',
+        help = 'how codes get to the worker (default: queue)')
+    parser.add_argument('--overlap', choices = ('queue', 'coalesce', 'reject'),
+        default = 'queue')
+    parser.add_argument('-n', '--codes', type = int, default = 10,
+        help = 'how many codes to send, besides START_LISTENING and STOP_LISTENING')
+    parser.add_argument('--interval', type = float, default = 2,
+        help = 'seconds between codes (default: 2)')
+    parser.add_argument('--json', metavar = 'FILE',
+        help = 'also write the results to FILE as JSON')
+    args = parser.parse_args()
 
-for x in range(10):
-    trigger(x + 1)
-    wait(2)
+    results = []
+    for delay in args.delay or [.05]:
+        for worker in args.worker or ['process']:
+            for transport in args.transport or ['queue']:
+                r = run(args, delay, worker, transport)
+                results.append(r)
+                print '{} worker, {} transport, delay {} s: {} of {} codes sent, {:.1f} codes/s'.format(
+                    r['worker'], r['transport'], r['delay'], r['sent'], r['codes'], r['throughput'])
+                for k in 'wakeup', 'latency', 'pulse_width':
+                    print '    {:12} (ms) median {} p95 {} p99 {} max {}'.format(k,
+                        ms(r[k], 'median'), ms(r[k], 'p95'), ms(r[k], 'p99'), ms(r[k], 'max'))
 
-trigger(standard_actiview_trigger_codes['STOP_LISTENING'])
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, sort_keys = True, indent = 2)
+            print >>out
 
-print "Done"
+    print "Done"
+
+if __name__ == '__main__':
+    # On Windows, the worker process imports this module, so
+    # only the parent should run the benchmark.
+    main()